@@ -1,3 +1,5 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from . import controllers
 from . import models
 from . import wizard
+from .hooks import post_init_hook
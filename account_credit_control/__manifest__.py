@@ -3,7 +3,7 @@
 # Copyright 2018 Access Bookings Ltd (https://accessbookings.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 {'name': 'Account Credit Control',
- 'version': '12.0.1.0.3',
+ 'version': '12.0.1.1.0',
  'author': "Camptocamp,"
            "Odoo Community Association (OCA),"
            "Okia,"
@@ -29,11 +29,14 @@
 
      # Data
      "data/data.xml",
+     "data/ir_cron.xml",
 
      # Views
      "views/account_invoice.xml",
      "views/credit_control_line.xml",
+     "views/credit_control_job.xml",
      "views/credit_control_policy.xml",
+     "views/credit_control_business_calendar.xml",
      "views/credit_control_run.xml",
      "views/res_company.xml",
      "views/res_partner.xml",
@@ -48,4 +51,5 @@
  'installable': True,
  'license': 'AGPL-3',
  'application': True,
+ 'post_init_hook': 'post_init_hook',
  }
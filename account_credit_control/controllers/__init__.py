@@ -0,0 +1,3 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from . import main
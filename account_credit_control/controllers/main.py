@@ -0,0 +1,23 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from werkzeug.exceptions import NotFound
+
+from odoo import http
+from odoo.http import request
+from odoo.tools import consteq
+
+
+class CreditControlController(http.Controller):
+
+    @http.route('/account_credit_control/letters/<int:printer_id>/<token>',
+                type='http', auth='user')
+    def download_letters(self, printer_id, token, **kwargs):
+        """ Stream the letters exported by the printer from the disk """
+        printer = request.env['credit.control.printer'].browse(
+            printer_id).exists()
+        if not printer or not printer.export_path or \
+                not consteq(printer.export_token or '', token):
+            raise NotFound()
+        return http.send_file(printer.export_path,
+                              filename=printer.export_filename,
+                              as_attachment=True)
@@ -0,0 +1,12 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from odoo import SUPERUSER_ID, api
+
+
+def post_init_hook(cr, registry):
+    """ Fill the credit control policy of the existing move lines, the
+    columns of the policies were not all created when the move lines
+    were initialized
+    """
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['account.move.line']._fill_credit_policy()
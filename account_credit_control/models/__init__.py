@@ -1,6 +1,9 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 from . import account_account
 from . import account_invoice
+from . import account_move_line
+from . import credit_control_business_calendar
+from . import credit_control_job
 from . import credit_control_line
 from . import credit_control_policy
 from . import credit_control_run
@@ -0,0 +1,173 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import logging
+
+from odoo import api, fields, models
+from odoo.tools.sql import column_exists, create_column, table_exists
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountMoveLine(models.Model):
+    """ Keep the current credit control level of the move lines, so the
+    run does not have to look for it in the history of the credit lines.
+    """
+    _inherit = 'account.move.line'
+
+    credit_control_line_ids = fields.One2many(
+        comodel_name='credit.control.line',
+        inverse_name='move_line_id',
+        string='Credit Control Lines',
+        readonly=True,
+    )
+    credit_control_line_id = fields.Many2one(
+        comodel_name='credit.control.line',
+        string='Current Credit Control Line',
+        compute='_compute_credit_control_level',
+        store=True,
+        index=True,
+        compute_sudo=True,
+        help="Credit control line of the highest level which is neither "
+             "ignored nor manually overridden.",
+    )
+    credit_control_level = fields.Integer(
+        string='Current Credit Control Level',
+        compute='_compute_credit_control_level',
+        store=True,
+        compute_sudo=True,
+    )
+    credit_control_state = fields.Selection(
+        selection=lambda self: (
+            self.env['credit.control.line']._fields['state'].selection
+        ),
+        string='Current Credit Control State',
+        compute='_compute_credit_control_level',
+        store=True,
+        compute_sudo=True,
+    )
+    credit_policy_id = fields.Many2one(
+        comodel_name='credit.control.policy',
+        string='Credit Control Policy',
+        compute='_compute_credit_policy_id',
+        store=True,
+        index=True,
+        compute_sudo=True,
+        help="Credit Control Policy applied on the move line: the one of "
+             "the invoice, otherwise the one of the partner, otherwise "
+             "the one of the company.",
+    )
+    credit_control_reminded = fields.Boolean(
+        string='Reminded',
+        compute='_compute_credit_control_level',
+        store=True,
+        compute_sudo=True,
+        help="A credit control line which is neither draft, ignored nor "
+             "manually overridden exists for this move line.",
+    )
+
+    @api.multi
+    @api.depends('credit_control_line_ids.level',
+                 'credit_control_line_ids.state',
+                 'credit_control_line_ids.manually_overridden')
+    def _compute_credit_control_level(self):
+        for move_line in self:
+            cc_lines = move_line.credit_control_line_ids.filtered(
+                lambda line: not line.manually_overridden)
+            current = cc_lines.filtered(
+                lambda line: line.state != 'ignored')
+            current = current.sorted(
+                key=lambda line: (line.level, line.id), reverse=True)[:1]
+            move_line.credit_control_line_id = current
+            move_line.credit_control_level = current.level
+            move_line.credit_control_state = current.state
+            move_line.credit_control_reminded = any(
+                line.state not in ('draft', 'ignored') for line in cc_lines)
+
+    @api.multi
+    @api.depends('invoice_id.credit_policy_id',
+                 'partner_id.credit_policy_id',
+                 'company_id')
+    def _compute_credit_policy_id(self):
+        # there is a priority between the policies: invoice > partner >
+        # company. A change of the policy of a company is propagated by
+        # ``res.company._update_move_lines_credit_policy``, a dependency
+        # would recompute all the move lines of the company.
+        for move_line in self:
+            move_line.credit_policy_id = (
+                move_line.invoice_id.credit_policy_id or
+                move_line.partner_id.credit_policy_id or
+                move_line.company_id.credit_policy_id
+            )
+
+    @api.model_cr_context
+    def _auto_init(self):
+        """ Fill the current credit control level of the existing move
+        lines with SQL, the ORM would compute them record per record
+        """
+        cr = self.env.cr
+        if not column_exists(cr, self._table, 'credit_control_line_id'):
+            create_column(cr, self._table, 'credit_control_line_id', 'int4')
+            create_column(cr, self._table, 'credit_control_level', 'int4')
+            create_column(cr, self._table, 'credit_control_state',
+                          'varchar')
+            create_column(cr, self._table, 'credit_control_reminded',
+                          'bool')
+            if table_exists(cr, 'credit_control_line'):
+                cr.execute(
+                    "UPDATE account_move_line mv_line\n"
+                    " SET credit_control_line_id = cur.id,\n"
+                    "     credit_control_level = cur.level,\n"
+                    "     credit_control_state = cur.state,\n"
+                    "     credit_control_reminded = cur.reminded\n"
+                    " FROM (\n"
+                    "   SELECT DISTINCT ON (move_line_id)\n"
+                    "          move_line_id, id, level, state,\n"
+                    "          bool_or(state != 'draft')\n"
+                    "            OVER (PARTITION BY move_line_id)\n"
+                    "            AS reminded\n"
+                    "   FROM credit_control_line\n"
+                    "   WHERE state != 'ignored'\n"
+                    "   AND NOT manually_overridden\n"
+                    "   ORDER BY move_line_id, level DESC, id DESC\n"
+                    " ) cur\n"
+                    " WHERE cur.move_line_id = mv_line.id"
+                )
+        if not column_exists(cr, self._table, 'credit_policy_id'):
+            create_column(cr, self._table, 'credit_policy_id', 'int4')
+            if all(column_exists(cr, table, 'credit_policy_id')
+                   for table in ('account_invoice', 'res_partner',
+                                 'res_company')):
+                self._fill_credit_policy()
+            else:
+                _logger.info(
+                    "Credit control policies of the move lines not filled, "
+                    "the policies of the invoices, partners and companies "
+                    "do not exist yet. They are filled after the "
+                    "installation of the module.")
+        return super(AccountMoveLine, self)._auto_init()
+
+    @api.model
+    def _fill_credit_policy(self):
+        """ Fill the credit control policy of the move lines with SQL,
+        the ORM would compute them record per record
+        """
+        self.env.cr.execute(
+            "UPDATE account_move_line mv_line\n"
+            " SET credit_policy_id = COALESCE(\n"
+            "     inv.credit_policy_id,\n"
+            "     partner.credit_policy_id,\n"
+            "     company.credit_policy_id)\n"
+            " FROM account_move_line aml\n"
+            " LEFT JOIN account_invoice inv\n"
+            "   ON (inv.id = aml.invoice_id)\n"
+            " LEFT JOIN res_partner partner\n"
+            "   ON (partner.id = aml.partner_id)\n"
+            " LEFT JOIN res_company company\n"
+            "   ON (company.id = aml.company_id)\n"
+            " WHERE aml.id = mv_line.id\n"
+            " AND mv_line.credit_policy_id IS DISTINCT FROM COALESCE(\n"
+            "     inv.credit_policy_id,\n"
+            "     partner.credit_policy_id,\n"
+            "     company.credit_policy_id)"
+        )
+        self.invalidate_cache(['credit_policy_id'])
@@ -0,0 +1,70 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from collections import namedtuple
+
+ComputationMode = namedtuple(
+    'ComputationMode',
+    ['code', 'label', 'sql', 'params', 'evaluator', 'sequence'],
+)
+
+# computation modes of the date boundary of the policy levels, by code
+COMPUTATION_MODES = {}
+
+
+def register_computation_mode(code, label, sql=None, params=None,
+                              evaluator=None, sequence=10):
+    """ Register a computation mode of the policy levels
+
+    A mode gives the SQL clause of its date boundary, evaluated on all the
+    move lines at once, or a Python evaluator when the boundary cannot be
+    expressed in SQL. The SQL clause is used when both are given.
+
+    :param str code: value of the mode in ``computation_mode``
+    :param str label: label of the mode
+    :param sql: function returning, for a level, the where clause of the
+        boundary on ``mv_line`` and ``cr_line``, the current credit line
+        of the move line. It may use the ``controlling_date`` and
+        ``delay`` parameters and the ones returned by ``params``.
+    :param params: function returning, for a level, a dict with the other
+        parameters of the SQL clause
+    :param evaluator: function called with a level, the controlling date
+        and the lists of the maturity dates and of the dates of the
+        previous reminders of move lines, returning a list telling for
+        each move line whether the boundary is reached
+    :param int sequence: position of the mode in the selection
+    """
+    assert sql or evaluator, "A computation mode needs an evaluator"
+    COMPUTATION_MODES[code] = ComputationMode(
+        code, label, sql, params, evaluator, sequence)
+
+
+def get_computation_mode_selection():
+    """ Return the selection of the registered computation modes """
+    modes = sorted(COMPUTATION_MODES.values(),
+                   key=lambda mode: (mode.sequence, mode.code))
+    return [(mode.code, mode.label) for mode in modes]
+
+
+register_computation_mode(
+    'net_days', 'Due Date',
+    sql=lambda level: level._net_days_get_boundary(),
+    sequence=10,
+)
+register_computation_mode(
+    'end_of_month', 'Due Date, End Of Month',
+    sql=lambda level: level._end_of_month_get_boundary(),
+    sequence=20,
+)
+register_computation_mode(
+    'previous_date', 'Previous Reminder',
+    sql=lambda level: level._previous_date_get_boundary(),
+    sequence=30,
+)
+register_computation_mode(
+    'business_days', 'Due Date, Business Days',
+    sql=lambda level: level._business_days_get_boundary(),
+    params=lambda level: {
+        'calendar_id': level.business_calendar_id.id or None,
+    },
+    sequence=40,
+)
@@ -0,0 +1,284 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from datetime import date
+
+from odoo import _, api, fields, models
+from odoo.exceptions import ValidationError
+from odoo.tools.sql import index_exists
+
+
+class CreditControlBusinessCalendar(models.Model):
+    """ Working days of a country, used by the levels counting their delay
+    in business days
+
+    The ordinal of every day of the calendar is stored in
+    ``credit.control.business.day``, so the date boundary of a level stays
+    a comparison of two ordinals in SQL.
+    """
+
+    _name = "credit.control.business.calendar"
+    _description = "Credit control business calendar"
+
+    @api.model
+    def _default_date_from(self):
+        return date(fields.Date.today().year - 5, 1, 1)
+
+    @api.model
+    def _default_date_to(self):
+        return date(fields.Date.today().year + 5, 12, 31)
+
+    name = fields.Char(
+        required=True,
+    )
+    country_id = fields.Many2one(
+        comodel_name='res.country',
+        string='Country',
+        index=True,
+        copy=False,
+        help="The business days of the partners of this country are "
+             "counted with this calendar, whatever the calendar of the "
+             "policy level.",
+    )
+    weekend_days = fields.Char(
+        required=True,
+        default='6,7',
+        help="Days of the week which are not worked, as a comma separated "
+             "list of ISO numbers of the days, from 1 for Monday to 7 for "
+             "Sunday.",
+    )
+    date_from = fields.Date(
+        string='From',
+        required=True,
+        default=lambda self: self._default_date_from(),
+    )
+    date_to = fields.Date(
+        string='To',
+        required=True,
+        default=lambda self: self._default_date_to(),
+        help="The business days are counted between these dates, the "
+             "delays of the move lines outside of them are counted in "
+             "calendar days.",
+    )
+    holiday_ids = fields.One2many(
+        comodel_name='credit.control.business.holiday',
+        inverse_name='calendar_id',
+        string='Holidays',
+        copy=True,
+    )
+
+    _sql_constraints = [
+        ('country_uniq', 'unique(country_id)',
+         'A country can only have one business calendar.'),
+    ]
+
+    @api.multi
+    @api.constrains('weekend_days')
+    def _check_weekend_days(self):
+        for calendar in self:
+            try:
+                days = calendar._get_weekend_days()
+            except ValueError:
+                days = None
+            if days is None or not set(days) <= set(range(1, 8)):
+                raise ValidationError(
+                    _('The weekend days must be a comma separated list of '
+                      'numbers from 1 (Monday) to 7 (Sunday).'))
+
+    @api.multi
+    @api.constrains('date_from', 'date_to')
+    def _check_dates(self):
+        for calendar in self:
+            if calendar.date_from > calendar.date_to:
+                raise ValidationError(
+                    _('The start date of the calendar must precede its '
+                      'end date.'))
+
+    @api.multi
+    def _get_weekend_days(self):
+        """ ISO numbers of the days of the week which are not worked """
+        self.ensure_one()
+        return [int(day) for day in self.weekend_days.split(',')
+                if day.strip()]
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        calendars = super(CreditControlBusinessCalendar, self).create(
+            vals_list)
+        calendars._compute_business_days()
+        return calendars
+
+    @api.multi
+    def write(self, vals):
+        res = super(CreditControlBusinessCalendar, self).write(vals)
+        # the holidays compute the business days of their calendar
+        if {'weekend_days', 'date_from', 'date_to'} & set(vals):
+            self._compute_business_days()
+        return res
+
+    @api.multi
+    def _compute_business_days(self, date_start=None):
+        """ Store the business day ordinal of every day of the calendars
+
+        The ordinal of a day is the number of business days from the start
+        of the calendar up to this day, so the number of business days
+        between two days is the difference of their ordinals.
+
+        :param date_start: first day whose ordinal may have changed, e.g.
+            the date of a new holiday, the ordinals of the previous days
+            are kept. All the days are computed when it is not given.
+        """
+        if not self:
+            return
+        cr = self.env.cr
+        for calendar in self:
+            if date_start is None:
+                start = calendar.date_from
+                cr.execute("DELETE FROM credit_control_business_day"
+                           " WHERE calendar_id = %s", (calendar.id, ))
+            else:
+                start = max(fields.Date.to_date(date_start),
+                            calendar.date_from)
+                cr.execute("DELETE FROM credit_control_business_day"
+                           " WHERE calendar_id = %s AND date >= %s",
+                           (calendar.id, start))
+            # the ordinals go on from the one of the day before the start
+            cr.execute(
+                "INSERT INTO credit_control_business_day\n"
+                "   (calendar_id, date, ordinal)\n"
+                " SELECT %(calendar_id)s, day.date,\n"
+                "        COALESCE((SELECT ordinal\n"
+                "                  FROM credit_control_business_day\n"
+                "                  WHERE calendar_id = %(calendar_id)s\n"
+                "                  AND date = %(date_from)s::date - 1),\n"
+                "                 0)\n"
+                "        + count(*) FILTER (WHERE day.business)\n"
+                "            OVER (ORDER BY day.date)\n"
+                " FROM (\n"
+                "   SELECT series.day::date AS date,\n"
+                "          NOT (extract(isodow FROM series.day)::integer\n"
+                "               = ANY(%(weekend_days)s::integer[]))\n"
+                "          AND NOT EXISTS (\n"
+                "            SELECT id FROM credit_control_business_holiday\n"
+                "            WHERE calendar_id = %(calendar_id)s\n"
+                "            AND date = series.day::date) AS business\n"
+                "   FROM generate_series(%(date_from)s::date,\n"
+                "                        %(date_to)s::date,\n"
+                "                        interval '1 day') AS series(day)\n"
+                " ) AS day",
+                {'calendar_id': calendar.id,
+                 'weekend_days': calendar._get_weekend_days(),
+                 'date_from': start,
+                 'date_to': calendar.date_to})
+        # the incremental runs evaluate all the lines of the levels using
+        # a calendar changed since the previous run
+        cr.execute("UPDATE credit_control_business_calendar"
+                   " SET write_date = now() at time zone 'UTC'"
+                   " WHERE id IN %s", (tuple(self.ids), ))
+        self.invalidate_cache(['write_date'], self.ids)
+        self.env['credit.control.business.day'].invalidate_cache()
+
+    @api.multi
+    def action_compute_business_days(self):
+        self._compute_business_days()
+        return True
+
+
+class CreditControlBusinessHoliday(models.Model):
+    """ Day which is not worked in a business calendar """
+
+    _name = "credit.control.business.holiday"
+    _description = "Credit control business holiday"
+    _order = "date"
+
+    name = fields.Char(
+        required=True,
+    )
+    calendar_id = fields.Many2one(
+        comodel_name='credit.control.business.calendar',
+        string='Calendar',
+        required=True,
+        ondelete='cascade',
+        index=True,
+    )
+    date = fields.Date(
+        required=True,
+    )
+
+    @api.multi
+    def _get_calendar_starts(self, starts=None):
+        """ Earliest holiday of every calendar, from which the business
+        days of the calendar are computed again
+
+        :param starts: dict of the earliest dates of the calendars to
+            update
+        :return: dict with the earliest date of every calendar
+        """
+        starts = dict(starts or {})
+        for holiday in self:
+            calendar = holiday.calendar_id
+            starts[calendar] = min(starts.get(calendar, holiday.date),
+                                   holiday.date)
+        return starts
+
+    @api.model
+    def _compute_business_days_from(self, starts):
+        for calendar, date_start in starts.items():
+            calendar.exists()._compute_business_days(date_start=date_start)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        holidays = super(CreditControlBusinessHoliday, self).create(
+            vals_list)
+        self._compute_business_days_from(holidays._get_calendar_starts())
+        return holidays
+
+    @api.multi
+    def write(self, vals):
+        starts = self._get_calendar_starts()
+        res = super(CreditControlBusinessHoliday, self).write(vals)
+        if {'calendar_id', 'date'} & set(vals):
+            self._compute_business_days_from(
+                self._get_calendar_starts(starts))
+        return res
+
+    @api.multi
+    def unlink(self):
+        starts = self._get_calendar_starts()
+        res = super(CreditControlBusinessHoliday, self).unlink()
+        self._compute_business_days_from(starts)
+        return res
+
+
+class CreditControlBusinessDay(models.Model):
+    """ Business day ordinal of a day of a business calendar, filled by
+    ``credit.control.business.calendar._compute_business_days``
+    """
+
+    _name = "credit.control.business.day"
+    _description = "Credit control business day"
+    _log_access = False
+    _order = "calendar_id, date"
+
+    calendar_id = fields.Many2one(
+        comodel_name='credit.control.business.calendar',
+        string='Calendar',
+        required=True,
+        readonly=True,
+        ondelete='cascade',
+    )
+    date = fields.Date(
+        required=True,
+        readonly=True,
+    )
+    ordinal = fields.Integer(
+        required=True,
+        readonly=True,
+    )
+
+    @api.model_cr
+    def init(self):
+        cr = self.env.cr
+        if not index_exists(cr, 'credit_control_business_day_date_index'):
+            cr.execute("CREATE UNIQUE INDEX"
+                       " credit_control_business_day_date_index"
+                       " ON credit_control_business_day (calendar_id, date)")
@@ -0,0 +1,308 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import base64
+import logging
+
+from odoo import _, api, fields, models, tools
+
+_logger = logging.getLogger(__name__)
+
+
+class CreditControlJob(models.Model):
+    """ Background execution of the emailer, printer and marker wizards
+
+    The lines of a job are processed per chunk of partners by a scheduled
+    action which commits after every chunk, so a large selection does not
+    hit the time limit of a request.
+    """
+
+    _name = "credit.control.job"
+    _inherit = ['mail.thread']
+    _description = "Credit control background job"
+    _order = "id DESC"
+
+    name = fields.Char(
+        required=True,
+        readonly=True,
+    )
+    action = fields.Selection(
+        selection=[
+            ('email', 'Send By Email'),
+            ('print', 'Print'),
+            ('mark', "Change Lines' State"),
+        ],
+        required=True,
+        readonly=True,
+    )
+    state = fields.Selection(
+        selection=[
+            ('pending', 'Pending'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+        ],
+        required=True,
+        readonly=True,
+        default='pending',
+        track_visibility='onchange',
+    )
+    user_id = fields.Many2one(
+        comodel_name='res.users',
+        string='User',
+        required=True,
+        readonly=True,
+        default=lambda self: self.env.user,
+    )
+    company_id = fields.Many2one(
+        comodel_name='res.company',
+        string='Company',
+        readonly=True,
+        default=lambda self: self.env.user.company_id,
+    )
+    line_ids = fields.Many2many(
+        comodel_name='credit.control.line',
+        relation='credit_control_job_line_rel',
+        column1='job_id',
+        column2='line_id',
+        string='Credit Control Lines',
+        readonly=True,
+    )
+    done_line_ids = fields.Many2many(
+        comodel_name='credit.control.line',
+        relation='credit_control_job_done_line_rel',
+        column1='job_id',
+        column2='line_id',
+        string='Processed Lines',
+        readonly=True,
+    )
+    line_count = fields.Integer(
+        string='Lines',
+        readonly=True,
+    )
+    done_count = fields.Integer(
+        string='Processed Lines',
+        readonly=True,
+    )
+    progress = fields.Float(
+        compute='_compute_progress',
+    )
+    mark_state = fields.Selection(
+        selection=lambda self: (
+            self.env['credit.control.marker']._fields['name'].selection
+        ),
+        string='Mark as',
+        readonly=True,
+    )
+    mark_as_sent = fields.Boolean(
+        string='Mark letter lines as sent',
+        readonly=True,
+    )
+    error = fields.Text(
+        readonly=True,
+    )
+    attachment_ids = fields.One2many(
+        comodel_name='ir.attachment',
+        inverse_name='res_id',
+        domain=[('res_model', '=', 'credit.control.job')],
+        string='Files',
+        readonly=True,
+    )
+
+    @api.multi
+    @api.depends('line_count', 'done_count', 'state')
+    def _compute_progress(self):
+        for job in self:
+            if job.line_count:
+                job.progress = 100.0 * job.done_count / job.line_count
+            else:
+                job.progress = 100.0 if job.state == 'done' else 0.0
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        # the lines are processed as the user of the job, which can only
+        # be the user creating it
+        for vals in vals_list:
+            vals['user_id'] = self.env.uid
+        return super(CreditControlJob, self).create(vals_list)
+
+    @api.multi
+    def write(self, vals):
+        vals.pop('user_id', None)
+        return super(CreditControlJob, self).write(vals)
+
+    @api.model
+    def _open_new_job(self, action, lines, vals=None):
+        """ Create a job and return the action showing it
+
+        :param str action: action of the job
+        :param lines: recordset of the credit control lines to process
+        :param vals: dict of other values of the job
+        """
+        vals = dict(vals or {},
+                    action=action,
+                    line_ids=[(6, 0, lines.ids)],
+                    line_count=len(lines))
+        vals.setdefault('name', _('%s of %d credit control lines') % (
+            dict(self._fields['action'].selection)[action], len(lines)))
+        job = self.create(vals)
+        job.message_subscribe(partner_ids=job.user_id.partner_id.ids)
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': job.id,
+            'view_mode': 'form',
+            'target': 'current',
+        }
+
+    @api.model
+    def _get_chunk_size(self):
+        """ Number of lines processed between two commits """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return max(int(get_param('account_credit_control.job_chunk_size',
+                                 100)), 1)
+
+    @api.multi
+    def _get_chunks(self):
+        """ Split the lines left to process in chunks which do not split the
+        lines of a partner, so the lines of a partner end up in the same
+        communication
+
+        :return: list of recordsets of credit control lines
+        """
+        self.ensure_one()
+        self.env.cr.execute(
+            "SELECT line.id, line.partner_id\n"
+            " FROM credit_control_job_line_rel rel\n"
+            " JOIN credit_control_line line ON (line.id = rel.line_id)\n"
+            " WHERE rel.job_id = %(job_id)s\n"
+            " AND line.id NOT IN (\n"
+            "   SELECT line_id FROM credit_control_job_done_line_rel\n"
+            "   WHERE job_id = %(job_id)s)\n"
+            " ORDER BY line.partner_id, line.id",
+            {'job_id': self.id})
+        size = self._get_chunk_size()
+        chunks = []
+        chunk = []
+        last_partner_id = None
+        for line_id, partner_id in self.env.cr.fetchall():
+            if len(chunk) >= size and partner_id != last_partner_id:
+                chunks.append(chunk)
+                chunk = []
+            chunk.append(line_id)
+            last_partner_id = partner_id
+        if chunk:
+            chunks.append(chunk)
+        line_obj = self.env['credit.control.line']
+        return [line_obj.browse(line_ids) for line_ids in chunks]
+
+    @api.multi
+    def _process_chunk(self, lines):
+        """ Run the action of the job on a chunk of lines
+
+        :return: recordset of ir.attachment produced by the chunk
+        """
+        self.ensure_one()
+        comm_obj = self.env['credit.control.communication']
+        attachments = self.env['ir.attachment']
+        if self.action == 'email':
+            lines = self.env['credit.control.emailer']._filter_lines(lines)
+            comm_obj._generate_emails_from_credit_lines(lines)
+        elif self.action == 'print':
+            comms = comm_obj._generate_comm_from_credit_lines(lines)
+            if self.mark_as_sent:
+                comms._mark_credit_line_as_sent()
+            report_name = \
+                'account_credit_control.report_credit_control_summary'
+            report = self.env['ir.actions.report']._get_report_from_name(
+                report_name)
+            pdf = report.render_qweb_pdf(comms.ids)[0]
+            part = attachments.search_count([
+                ('res_model', '=', self._name),
+                ('res_id', '=', self.id),
+            ]) + 1
+            filename = '%s - %d.pdf' % (report.name, part)
+            attachments = attachments.create({
+                'name': filename,
+                'datas': base64.b64encode(pdf),
+                'datas_fname': filename,
+                'res_model': self._name,
+                'res_id': self.id,
+                'type': 'binary',
+                'mimetype': 'application/pdf',
+            })
+        elif self.action == 'mark':
+            marker_obj = self.env['credit.control.marker']
+            lines = marker_obj._filter_lines(lines)
+            marker_obj._mark_lines(lines, self.mark_state)
+        return attachments
+
+    def _commit_progress(self):
+        """ Commit the progress of the job, every chunk is kept even when
+        a later one fails
+        """
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    @api.multi
+    def _process(self):
+        """ Process the lines of the job per chunk, as its user """
+        self.ensure_one()
+        job = self.sudo(self.user_id).with_context(
+            force_company=self.company_id.id)
+        job.write({'state': 'running'})
+        self._commit_progress()
+        index, chunk = 0, None
+        try:
+            for index, chunk in enumerate(job._get_chunks(), 1):
+                job._process_chunk(chunk)
+                job.write({
+                    'done_line_ids': [(4, line_id) for line_id in chunk.ids],
+                    'done_count': job.done_count + len(chunk),
+                })
+                self._commit_progress()
+        except Exception as exc:
+            _logger.exception("Credit control job %s failed", self.id)
+            self.env.cr.rollback()
+            error = tools.ustr(exc)
+            if chunk is not None:
+                # the previous chunks are committed, with their files
+                error = _('Chunk %d (%d lines of %s) failed after %d '
+                          'processed lines: %s') % (
+                    index, len(chunk),
+                    ', '.join(chunk.mapped('partner_id.display_name')),
+                    self.done_count, error)
+            self.write({'state': 'failed', 'error': error})
+            self._notify_user(_('The job failed: %s') % error)
+        else:
+            self.write({'state': 'done'})
+            self._notify_user(_('The job is done: %d credit control lines '
+                                'have been processed.') % self.done_count)
+        self._commit_progress()
+
+    @api.multi
+    def _notify_user(self, body):
+        """ Notify the user of the job, with the files it produced """
+        self.ensure_one()
+        self.message_post(
+            body=body,
+            partner_ids=self.user_id.partner_id.ids,
+            attachment_ids=self.attachment_ids.ids,
+            subtype='mail.mt_comment',
+        )
+
+    @api.model
+    def _cron_process_jobs(self):
+        """ Process the pending jobs, scheduled action entry point """
+        jobs = self.search([('state', 'in', ('pending', 'running'))],
+                           order='id')
+        for job in jobs:
+            job._process()
+        return True
+
+    @api.multi
+    def open_lines(self):
+        self.ensure_one()
+        action = self.env.ref(
+            'account_credit_control.credit_control_line_action')
+        action = action.read()[0]
+        action['domain'] = [('id', 'in', self.line_ids.ids)]
+        return action
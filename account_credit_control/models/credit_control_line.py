@@ -1,10 +1,15 @@
 # Copyright 2012-2017 Camptocamp SA
 # Copyright 2017 Okia SPRL (https://okia.be)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from collections import Counter
+
+from psycopg2 import sql
 
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
+from odoo.tools.sql import index_exists
 from .credit_control_policy import CHANNEL_LIST
+from .sql_ids import ids_condition
 
 
 class CreditControlLine(models.Model):
@@ -53,6 +58,7 @@ class CreditControlLine(models.Model):
             ('draft', 'Draft'),
             ('ignored', 'Ignored'),
             ('to_be_sent', 'Ready To Send'),
+            ('queued', 'Queued'),
             ('sent', 'Done'),
             ('error', 'Error'),
             ('email_error', 'Emailing Error'),
@@ -64,7 +70,8 @@ class CreditControlLine(models.Model):
              "Ignored lines are lines for which we do "
              "not want to send something.\n"
              "Draft and ignored lines will be "
-             "generated again on the next run.",
+             "generated again on the next run.\n"
+             "Queued lines wait for the delivery of their email.",
     )
     channel = fields.Selection(
         selection=CHANNEL_LIST,
@@ -152,6 +159,54 @@ class CreditControlLine(models.Model):
         store=True,
     )
 
+    @api.model
+    def _get_partial_indexes(self):
+        """ Indexes matching the predicates of the raw queries on the lines
+
+        The level queries do not filter the credit lines on their level and
+        state anymore, they read the current level and state stored on the
+        move lines (see ``account.move.line._compute_credit_control_level``)
+        restricted by the primary key of the move lines, so no index on
+        the level and state of the credit lines is needed for them. The
+        indexes below serve the other queries on the credit lines, and the
+        run date check is served by the index on ``date``.
+
+        An index whose definition changes has to be renamed, so it is
+        created again by ``init``.
+
+        :return: list of tuples with the name and the definition of the
+            indexes
+        """
+        return [
+            # move lines having a credit line on another policy
+            # (credit.control.policy._lines_different_policy and the
+            # preview of a policy)
+            ('credit_control_line_move_line_policy_index',
+             "(move_line_id, policy_id) WHERE manually_overridden IS false"),
+            # credit lines of a move line changed since the previous run
+            # (credit.control.run._filter_changed_move_lines)
+            ('credit_control_line_move_line_write_index',
+             "(move_line_id, write_date)"),
+            # draft lines left on a level, ignored by the next run
+            # (create_or_update_from_mv_lines)
+            ('credit_control_line_draft_level_index',
+             "(policy_level_id, move_line_id) WHERE state = 'draft'"),
+            # lines waiting for the delivery of their email
+            # (mail.mail._credit_control_postprocess)
+            ('credit_control_line_queued_mail_index',
+             "(mail_message_id) WHERE state = 'queued'"),
+        ]
+
+    @api.model_cr
+    def init(self):
+        cr = self.env.cr
+        for name, definition in self._get_partial_indexes():
+            if not index_exists(cr, name):
+                # the definitions are given by _get_partial_indexes
+                cr.execute(sql.SQL("CREATE INDEX {} ON {} {}").format(
+                    sql.Identifier(name), sql.Identifier(self._table),
+                    sql.SQL(definition)))
+
     @api.depends('partner_id.user_id')
     def _compute_partner_user_id(self):
         for line in self:
@@ -176,6 +231,25 @@ class CreditControlLine(models.Model):
         data['move_line_id'] = move_line.id
         return data
 
+    @api.model
+    def _get_tolerances(self):
+        """ Return the open amount under which no credit line is created
+
+        :return: tuple with a dict of the tolerance per currency id, the
+            tolerance of the company and the currency of the company
+        """
+        currency_obj = self.env['res.currency']
+        user = self.env.user
+        currencies = currency_obj.search([])
+
+        tolerance = {}
+        tolerance_base = user.company_id.credit_control_tolerance
+        user_currency = user.company_id.currency_id
+        for currency in currencies:
+            tolerance[currency.id] = currency.compute(
+                tolerance_base, user_currency)
+        return tolerance, tolerance_base, user_currency
+
     @api.model
     def create_or_update_from_mv_lines(self, lines, level, controlling_date,
                                        check_tolerance=True):
@@ -198,18 +272,9 @@ class CreditControlLine(models.Model):
 
         :returns: recordset of created credit lines
         """
-        currency_obj = self.env['res.currency']
-        user = self.env.user
-        currencies = currency_obj.search([])
+        tolerance, tolerance_base, user_currency = self._get_tolerances()
 
-        tolerance = {}
-        tolerance_base = user.company_id.credit_control_tolerance
-        user_currency = user.company_id.currency_id
-        for currency in currencies:
-            tolerance[currency.id] = currency.compute(
-                tolerance_base, user_currency)
-
-        new_lines = self.browse()
+        vals_list = []
         for move_line in lines:
             ml_currency = move_line.currency_id
             if ml_currency and ml_currency != user_currency:
@@ -220,22 +285,24 @@ class CreditControlLine(models.Model):
                                           tolerance_base)
             if check_tolerance and open_amount < cur_tolerance:
                 continue
-            vals = self._prepare_from_move_line(
-                move_line, level, controlling_date, open_amount)
-            line = self.create([vals])
-            new_lines |= line
-
-            # when we have lines generated earlier in draft,
-            # on the same level, it means that we have left
-            # them, so they are to be considered as ignored
-            previous_drafts = self.search([
-                ('move_line_id', '=', move_line.id),
-                ('policy_level_id', '=', level.id),
-                ('state', '=', 'draft'),
-                ('id', '!=', line.id),
-            ])
-            if previous_drafts:
-                previous_drafts.write({'state': 'ignored'})
+            vals_list.append(self._prepare_from_move_line(
+                move_line, level, controlling_date, open_amount))
+        if not vals_list:
+            return self.browse()
+        new_lines = self.create(vals_list)
+
+        # when we have lines generated earlier in draft,
+        # on the same level, it means that we have left
+        # them, so they are to be considered as ignored
+        previous_drafts = self.search([
+            ('move_line_id', 'in', new_lines.mapped('move_line_id').ids),
+            ('policy_level_id', '=', level.id),
+            ('state', '=', 'draft'),
+            ('id', 'not in', new_lines.ids),
+        ])
+        if previous_drafts:
+            previous_drafts._set_state('ignored', from_states=('draft',),
+                                       summary=False)
 
         return new_lines
 
@@ -260,10 +327,99 @@ class CreditControlLine(models.Model):
 
     @api.model_create_multi
     def create(self, vals_list):
-        lines = super(CreditControlLine, self).create(vals_list)
-        for line in lines:
-            line.manual_followup = line.partner_id.manual_followup
-        return lines
+        # propagate the partner's manual follow-up flag in the values
+        # rather than writing it on each line once created
+        partners = self.env['res.partner'].browse(
+            {vals['partner_id'] for vals in vals_list
+             if vals.get('partner_id')}
+        )
+        followup = {partner.id: partner.manual_followup
+                    for partner in partners}
+        # the values of the caller are left untouched
+        vals_list = [
+            dict(vals, manual_followup=followup.get(vals.get('partner_id'),
+                                                    False))
+            for vals in vals_list
+        ]
+        return super(CreditControlLine, self).create(vals_list)
+
+    @api.multi
+    def _set_state(self, state, from_states=None, summary=True):
+        """ Change the state of the lines in bulk
+
+        The state is not tracked, so rather than going through ``write``
+        for every line, the lines are updated with set-based queries and a
+        single summary message is posted on every partner.
+
+        The query bypasses ``write``: its overrides are not called and no
+        tracking value is logged on the lines. Only the stored fields
+        depending on the state, such as the current credit control state
+        of the move lines, are recomputed.
+
+        :param str state: new state of the lines
+        :param from_states: states the lines must be in to be changed, the
+            lines in another state are left untouched
+        :param bool summary: post a summary message on the partners
+        :return: recordset of the lines which have changed of state
+        """
+        if not self:
+            return self
+        self.check_access_rights('write')
+        self.check_access_rule('write')
+        cr = self.env.cr
+        with ids_condition(cr, 'id', self.ids) as (condition, params):
+            query = sql.SQL(
+                "UPDATE {table}\n"
+                " SET {state} = %(state)s,\n"
+                "     {write_uid} = %(uid)s,\n"
+                "     {write_date} = now() at time zone 'UTC'\n"
+                " WHERE {condition}\n"
+                " AND {state} != %(state)s\n"
+                " AND (%(from_states)s::varchar[] IS NULL\n"
+                "      OR {state} = ANY(%(from_states)s::varchar[]))\n"
+                " RETURNING id, partner_id"
+            ).format(
+                table=sql.Identifier(self._table),
+                state=sql.Identifier('state'),
+                write_uid=sql.Identifier('write_uid'),
+                write_date=sql.Identifier('write_date'),
+                condition=condition,
+            )
+            params.update(state=state, uid=self.env.uid,
+                          from_states=list(from_states or ()) or None)
+            cr.execute(query, params)
+            rows = cr.fetchall()
+        changed = self.browse([line_id for line_id, __ in rows])
+        changed.invalidate_cache(['state', 'write_uid', 'write_date'],
+                                 changed.ids)
+        # recompute the current credit control state of the move lines
+        changed.modified(['state'])
+        changed.recompute()
+        if summary and rows:
+            self._post_state_summary(
+                state, Counter(partner_id for __, partner_id in rows))
+        return changed
+
+    @api.model
+    def _post_state_summary(self, state, counts):
+        """ Post a note on the partners telling how many of their lines
+        changed of state
+
+        :param str state: new state of the lines
+        :param counts: dict with the number of lines per partner id
+        """
+        states = dict(self._fields['state']._description_selection(self.env))
+        subtype = self.env.ref('mail.mt_note')
+        author = self.env.user.partner_id
+        self.env['mail.message'].sudo().create([{
+            'model': 'res.partner',
+            'res_id': partner_id,
+            'message_type': 'notification',
+            'subtype_id': subtype.id,
+            'author_id': author.id,
+            'body': _('%d credit control lines set to %s.') % (
+                count, states[state]),
+        } for partner_id, count in counts.items()])
 
     def button_schedule_activity(self):
         ctx = self.env.context.copy()
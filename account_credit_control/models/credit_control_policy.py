@@ -1,8 +1,15 @@
 # Copyright 2012-2017 Camptocamp SA
 # Copyright 2017 Okia SPRL (https://okia.be)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from odoo import _, api, fields, models
+from psycopg2 import sql
+
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import UserError, ValidationError
+from .computation_mode import (
+    COMPUTATION_MODES,
+    get_computation_mode_selection,
+)
+from .sql_ids import ids_condition
 
 CHANNEL_LIST = [
     ('letter', 'Letter'),
@@ -57,134 +64,222 @@ class CreditControlPolicy(models.Model):
 
     @api.multi
     @api.returns('account.move.line')
-    def _due_move_lines(self, controlling_date):
-        """ Get the due move lines for the policy of the company.
-
-        The set of ids will be reduced and extended according
-        to the specific policies defined on partners and invoices.
+    def _get_move_lines_to_process(self, controlling_date):
+        """ Build a list of move lines ids to include in a run
+        for a policy at a given date.
 
-        Do not use direct SQL in order to respect security rules.
+        The priority between the policies of the invoice, the partner and
+        the company is resolved by the stored ``credit_policy_id`` of the
+        move lines.
 
-        Assume that only the receivable lines have a maturity date and that
-        accounts used in the policy are reconcilable.
+        :param str controlling_date: date of credit control
+        :return: recordset to include in the run
         """
         self.ensure_one()
-        move_l_obj = self.env['account.move.line']
-        user = self.env.user
-        if user.company_id.credit_policy_id.id != self.id:
-            return move_l_obj
-        domain_line = self._move_lines_domain(controlling_date)
-        return move_l_obj.search(domain_line)
+        domain = self._move_lines_domain(controlling_date)
+        domain.append(('credit_policy_id', '=', self.id))
+        return self.env['account.move.line'].search(domain)
 
     @api.multi
     @api.returns('account.move.line')
-    def _move_lines_subset(self, controlling_date, model, move_relation_field):
-        """ Get the move lines related to one model for a policy.
-
-        Do not use direct SQL in order to respect security rules.
-
-        Assume that only the receivable lines have a maturity date and that
-        accounts used in the policy are reconcilable.
-
-        The policy relation field must be named credit_policy_id.
-
-        :param str controlling_date: date of credit control
-        :param str model: name of the model where is defined a credit_policy_id
-        :param str move_relation_field: name of the field in account.move.line
-            which is a many2one to `model`
-        :return: recordset to add in the process, recordset to remove from
-            the process
+    def _lines_different_policy(self, lines):
+        """ Return a set of move lines ids for which there is an
+            existing credit line but with a different policy.
         """
         self.ensure_one()
-        # MARK possible place for a good optimisation
-        my_obj = self.env[model].with_context(active_test=False)
-        default_domain = self._move_lines_domain(controlling_date)
-
-        to_add = self.env['account.move.line']
-        to_remove = self.env['account.move.line']
-
-        # The lines which are linked to this policy have to be included in the
-        # run for this policy.
-        # If another object override the credit_policy_id (ie. invoice after
-        add_objs = my_obj.search([('credit_policy_id', '=', self.id)])
-        if add_objs:
-            domain = list(default_domain)
-            domain.append((move_relation_field, 'in', add_objs.ids))
-            to_add = to_add.search(domain)
-
-        # The lines which are linked to another policy do not have to be
-        # included in the run for this policy.
-        neg_objs = my_obj.search([('credit_policy_id', '!=', self.id),
-                                  ('credit_policy_id', '!=', False)])
-        if neg_objs:
-            domain = list(default_domain)
-            domain.append((move_relation_field, 'in', neg_objs.ids))
-            to_remove = to_remove.search(domain)
-        return to_add, to_remove
+        different_lines = self.env['account.move.line']
+        if not lines:
+            return different_lines
+        cr = self.env.cr
+        with ids_condition(cr, 'move_line_id', lines.ids,
+                           'line_ids') as (condition, params):
+            params['policy_id'] = self.id
+            query = sql.SQL("SELECT move_line_id FROM credit_control_line"
+                            "    WHERE policy_id != %(policy_id)s"
+                            "    AND {}"
+                            "    AND manually_overridden IS false"
+                            ).format(condition)
+            cr.execute(query, params)
+            res = cr.fetchall()
+        if res:
+            return different_lines.browse([row[0] for row in res])
+        return different_lines
 
     @api.multi
-    @api.returns('account.move.line')
-    def _get_partner_related_lines(self, controlling_date):
-        """ Get the move lines for a policy related to a partner.
+    def _get_level_classification_sql(self, controlling_date,
+                                      lines_condition, lines=None):
+        """ Return the query classifying move lines on the levels of the
+        policy, it selects the ``move_line_id`` and the ``level_id`` of
+        each move line reaching a level.
 
-        :param str controlling_date: date of credit control
-        :return: recordset to add in the process, recordset to remove from
-            the process
-        """
-        return self._move_lines_subset(
-            controlling_date, 'res.partner', 'partner_id',
-        )
-
-    @api.multi
-    @api.returns('account.move.line')
-    def _get_invoice_related_lines(self, controlling_date):
-        """ Get the move lines for a policy related to an invoice.
+        Each move line is matched against the level following its current
+        credit control level (or against the first level when no reminder
+        has been issued yet) and kept when the date boundary of that level
+        is reached.
 
         :param str controlling_date: date of credit control
-        :return: recordset to add in the process, recordset to remove from
-            the process
+        :param lines_condition: ``psycopg2.sql`` where clause on ``mv_line``
+            restricting the move lines to classify, its parameters are
+            given when the query is executed
+        :param lines: recordset of the move lines to classify, used by the
+            levels whose boundary is evaluated in Python
+        :return: ``psycopg2.sql.Composed`` query
         """
-        return self._move_lines_subset(
-            controlling_date, 'account.invoice', 'invoice_id',
+        self.ensure_one()
+        cr = self.env.cr
+        level_values = []
+        boundaries = []
+        level_obj = self.env['credit.control.policy.level']
+        # the levels in their order, with the number of their previous level
+        chain = level_obj._get_level_chain(self.id)
+        numbers = {level_id: number for level_id, number, __, __, __ in chain}
+        for level_id, __, __, previous_id, __ in chain:
+            level = level_obj.browse(level_id)
+            level_values.append(sql.SQL(cr.mogrify(
+                "(%s, %s::integer)", (level.id, numbers.get(previous_id)),
+            ).decode('utf-8')))
+            # the boundaries are rendered with their parameters
+            boundary = level._get_sql_date_boundary(controlling_date,
+                                                    lines=lines)
+            boundaries.append(sql.SQL("{} ({})").format(
+                sql.SQL(cr.mogrify("WHEN %s THEN", (level.id, )
+                                   ).decode('utf-8')),
+                sql.SQL(boundary.replace('%', '%%')),
+            ))
+        return sql.SQL(
+            "SELECT mv_line.id AS move_line_id,\n"
+            "       lvl.level_id AS level_id\n"
+            " FROM account_move_line mv_line\n"
+            # current credit line of the move line, ignored or manually
+            # overridden lines are not taken into account
+            " LEFT JOIN credit_control_line cr_line\n"
+            "   ON (cr_line.id = mv_line.credit_control_line_id)\n"
+            " JOIN (VALUES {level_values})\n"
+            "   AS lvl (level_id, previous_level)\n"
+            # lines from a previous level with a draft or ignored state
+            # or manually overridden
+            # have to be generated again for the previous level
+            "   ON ((lvl.previous_level IS NULL\n"
+            "        AND mv_line.credit_control_reminded IS NOT TRUE)\n"
+            "       OR (mv_line.credit_control_level =\n"
+            "           lvl.previous_level\n"
+            "           AND mv_line.credit_control_state\n"
+            "               NOT IN ('draft', 'ignored')))\n"
+            " WHERE {lines_condition}\n"
+            " AND (mv_line.debit IS NOT NULL AND mv_line.debit != 0.0)\n"
+            " AND CASE lvl.level_id {boundaries} ELSE false END\n"
+        ).format(
+            level_values=sql.SQL(', ').join(level_values),
+            lines_condition=lines_condition,
+            boundaries=sql.SQL(' ').join(boundaries),
         )
 
     @api.multi
-    @api.returns('account.move.line')
-    def _get_move_lines_to_process(self, controlling_date):
-        """ Build a list of move lines ids to include in a run
-        for a policy at a given date.
+    def _get_level_move_lines(self, controlling_date, lines):
+        """ Classify move lines on the levels of the policy in one query.
+
+        It gives the same result as calling ``get_level_lines`` on every
+        level of the policy.
 
         :param str controlling_date: date of credit control
-        :return: recordset to include in the run
+        :param lines: recordset of move lines to classify
+        :return: dict with the policy levels as keys and the recordset
+            of matching move lines as values
         """
         self.ensure_one()
-        # there is a priority between the lines, depicted by the calls below
-        lines = self._due_move_lines(controlling_date)
-        to_add, to_remove = self._get_partner_related_lines(controlling_date)
-        lines = (lines | to_add) - to_remove
-        to_add, to_remove = self._get_invoice_related_lines(controlling_date)
-        lines = (lines | to_add) - to_remove
-        return lines
+        move_line_obj = self.env['account.move.line']
+        levels = self.level_ids
+        result = {level: move_line_obj for level in levels}
+        if not lines or not levels:
+            return result
+        cr = self.env.cr
+        with ids_condition(cr, 'mv_line.id', lines.ids,
+                           'line_ids') as (condition, params):
+            query = self._get_level_classification_sql(
+                controlling_date, condition, lines=lines)
+            cr.execute(query, params)
+            rows = cr.fetchall()
+        ids_by_level = {}
+        for move_line_id, level_id in rows:
+            ids_by_level.setdefault(level_id, []).append(move_line_id)
+        for level in levels:
+            result[level] = move_line_obj.browse(
+                ids_by_level.get(level.id, []))
+        return result
 
     @api.multi
-    @api.returns('account.move.line')
-    def _lines_different_policy(self, lines):
-        """ Return a set of move lines ids for which there is an
-            existing credit line but with a different policy.
+    def _get_preview_data(self, controlling_date):
+        """ Compute, per level, the credit lines a run would generate for
+        the policy without creating them.
+
+        The move lines are selected and classified by aggregate queries,
+        the move lines bound to another policy by a credit line and the
+        ones below the tolerance are left out as done by a run.
+
+        :param str controlling_date: date of credit control
+        :return: list of dicts with the ``level``, the number of ``lines``
+            and ``partners`` and the open ``amount`` in company currency
         """
         self.ensure_one()
-        different_lines = self.env['account.move.line']
-        if not lines:
-            return different_lines
-        cr = self.env.cr
-        cr.execute("SELECT move_line_id FROM credit_control_line"
-                   "    WHERE policy_id != %s and move_line_id in %s"
-                   "    AND manually_overridden IS false",
-                   (self.id, tuple(lines.ids)))
-        res = cr.fetchall()
-        if res:
-            return different_lines.browse([row[0] for row in res])
-        return different_lines
+        if not self.level_ids:
+            return []
+        move_line_obj = self.env['account.move.line']
+        domain = self._move_lines_domain(controlling_date)
+        domain.append(('credit_policy_id', '=', self.id))
+        lines_query = move_line_obj._where_calc(domain)
+        move_line_obj._apply_ir_rules(lines_query, 'read')
+        from_clause, where_clause, where_params = lines_query.get_sql()
+        # the clauses generated by the ORM from the domain
+        candidates = sql.SQL(
+            "mv_line.id IN (SELECT account_move_line.id FROM {} WHERE {})"
+        ).format(sql.SQL(from_clause), sql.SQL(where_clause))
+
+        tolerance, tolerance_base, user_currency = \
+            self.env['credit.control.line']._get_tolerances()
+        query = sql.SQL(
+            "SELECT cls.level_id, count(*),\n"
+            "       count(DISTINCT mv_line.partner_id),\n"
+            "       sum(mv_line.amount_residual)\n"
+            " FROM ({classification}) cls\n"
+            " JOIN account_move_line mv_line\n"
+            "   ON (mv_line.id = cls.move_line_id)\n"
+            " LEFT JOIN unnest(%s::integer[], %s::numeric[])\n"
+            "   AS tol (currency_id, amount)\n"
+            "   ON (tol.currency_id = mv_line.currency_id)\n"
+            # move lines with a credit line on another policy have to
+            # be handled manually
+            " WHERE NOT EXISTS (SELECT id FROM credit_control_line\n"
+            "                   WHERE move_line_id = mv_line.id\n"
+            "                   AND policy_id != %s\n"
+            "                   AND manually_overridden IS false)\n"
+            " AND CASE WHEN mv_line.currency_id IS NOT NULL\n"
+            "           AND mv_line.currency_id != %s\n"
+            "          THEN mv_line.amount_residual_currency\n"
+            "          ELSE mv_line.amount_residual\n"
+            "     END >= COALESCE(tol.amount, %s)\n"
+            " GROUP BY cls.level_id"
+        ).format(
+            classification=self._get_level_classification_sql(
+                controlling_date, candidates),
+        )
+        currency_ids = list(tolerance)
+        params = where_params + [
+            currency_ids,
+            [tolerance[currency_id] for currency_id in currency_ids],
+            self.id, user_currency.id, tolerance_base,
+        ]
+        self.env.cr.execute(query, params)
+        stats = {row[0]: row[1:] for row in self.env.cr.fetchall()}
+        result = []
+        for level in self.level_ids:
+            lines, partners, amount = stats.get(level.id, (0, 0, 0.0))
+            result.append({
+                'level': level,
+                'lines': lines,
+                'partners': partners,
+                'amount': amount,
+            })
+        return result
 
     @api.multi
     def check_policy_against_account(self, account):
@@ -223,14 +318,18 @@ class CreditControlPolicyLevel(models.Model):
         required=True,
     )
     computation_mode = fields.Selection(
-        selection=[
-            ('net_days', 'Due Date'),
-            ('end_of_month', 'Due Date, End Of Month'),
-            ('previous_date', 'Previous Reminder')
-        ],
+        selection=lambda self: get_computation_mode_selection(),
         string='Compute Mode',
         required=True,
     )
+    business_calendar_id = fields.Many2one(
+        comodel_name='credit.control.business.calendar',
+        string='Business Calendar',
+        help="Calendar of the working days counted in the delay of the "
+             "level, for the \"Due Date, Business Days\" compute mode. "
+             "The calendar of the country of the partner is used instead "
+             "when there is one.",
+    )
     delay_days = fields.Integer(
         string='Delay (in days)',
         required=True,
@@ -263,6 +362,55 @@ class CreditControlPolicyLevel(models.Model):
                         'UNIQUE (policy_id, level)',
                         'Level must be unique per policy')]
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        # the constraints read the level chain during the creation
+        self._get_level_chain.clear_cache(self)
+        return super(CreditControlPolicyLevel, self).create(vals_list)
+
+    @api.multi
+    def write(self, vals):
+        if {'policy_id', 'level', 'computation_mode'} & set(vals):
+            # the constraints read the level chain during the write
+            self._get_level_chain.clear_cache(self)
+        return super(CreditControlPolicyLevel, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        res = super(CreditControlPolicyLevel, self).unlink()
+        self._get_level_chain.clear_cache(self)
+        return res
+
+    @api.model
+    @tools.ormcache('policy_id')
+    def _get_level_chain(self, policy_id):
+        """ Return the levels of a policy in their order, with the previous
+        and the next level of each of them
+
+        The previous level is the closest one with a smaller level, as
+        levels with the same number cannot follow each other.
+
+        :param int policy_id: id of the policy
+        :return: tuple with a tuple ``(id, level, computation_mode,
+            previous_id, next_id)`` per level
+        """
+        self.env.cr.execute(
+            "SELECT id, level, computation_mode\n"
+            " FROM credit_control_policy_level\n"
+            " WHERE policy_id = %s\n"
+            " ORDER BY level, id",
+            (policy_id, ))
+        rows = self.env.cr.fetchall()
+        chain = []
+        for index, (level_id, level, computation_mode) in enumerate(rows):
+            previous_id = next((row[0] for row in reversed(rows[:index])
+                                if row[1] < level), None)
+            next_id = next((row[0] for row in rows[index + 1:]
+                            if row[1] > level), None)
+            chain.append((level_id, level, computation_mode,
+                          previous_id, next_id))
+        return tuple(chain)
+
     @api.multi
     @api.constrains('level', 'computation_mode')
     def _check_level_mode(self):
@@ -270,13 +418,22 @@ class CreditControlPolicyLevel(models.Model):
         "previous_date".
         """
         for policy_level in self:
-            smallest_level = \
-                self.search([('policy_id', '=', policy_level.policy_id.id)],
-                            order='level asc', limit=1)
-            if smallest_level.computation_mode == 'previous_date':
+            chain = self._get_level_chain(policy_level.policy_id.id)
+            if chain and chain[0][2] == 'previous_date':
+                # the chain read in the failing transaction is discarded
+                self._get_level_chain.clear_cache(self)
                 raise ValidationError(_('The smallest level can not be '
                                         'of type Previous Reminder'))
 
+    @api.multi
+    @api.constrains('computation_mode', 'business_calendar_id')
+    def _check_business_calendar(self):
+        for policy_level in self:
+            if (policy_level.computation_mode == 'business_days' and
+                    not policy_level.business_calendar_id):
+                raise ValidationError(_('A business calendar is required to '
+                                        'count the delay in business days.'))
+
     @api.multi
     def _previous_level(self):
         """ For one policy level, returns the id of the previous level
@@ -287,13 +444,12 @@ class CreditControlPolicyLevel(models.Model):
         :return: previous level or None if there is no previous level
         """
         self.ensure_one()
-        previous_levels = self.search([
-            ('policy_id', '=', self.policy_id.id),
-            ('level', '<', self.level),
-        ], order='level desc', limit=1)
-        if not previous_levels:
+        chain = self._get_level_chain(self.policy_id.id)
+        previous_id = next((previous_id for level_id, __, __, previous_id, __
+                            in chain if level_id == self.id), None)
+        if not previous_id:
             return None
-        return previous_levels
+        return self.browse(previous_id)
 
     # ----- sql time related methods ---------
 
@@ -312,22 +468,124 @@ class CreditControlPolicyLevel(models.Model):
     def _previous_date_get_boundary():
         return "(cr_line.date + %(delay)s)::date <= date(%(controlling_date)s)"
 
+    @staticmethod
+    def _business_days_get_boundary():
+        # the calendar of the country of the partner prevails over the one
+        # of the level, outside of the business calendar, calendar days
+        # are counted. The calendar and the ordinals of the move line are
+        # looked up by a single subquery, on the (calendar_id, date) index
+        return ("(COALESCE(\n"
+                "  (SELECT ctl_day.ordinal - due_day.ordinal\n"
+                "   FROM (VALUES (mv_line.partner_id)) AS line(partner_id)\n"
+                "   LEFT JOIN res_partner partner\n"
+                "     ON (partner.id = line.partner_id)\n"
+                "   LEFT JOIN credit_control_business_calendar calendar\n"
+                "     ON (calendar.country_id = partner.country_id)\n"
+                "   JOIN credit_control_business_day due_day\n"
+                "     ON (due_day.calendar_id =\n"
+                "         COALESCE(calendar.id, %(calendar_id)s)\n"
+                "         AND due_day.date = mv_line.date_maturity)\n"
+                "   JOIN credit_control_business_day ctl_day\n"
+                "     ON (ctl_day.calendar_id = due_day.calendar_id\n"
+                "         AND ctl_day.date = date(%(controlling_date)s))\n"
+                "  ) >= %(delay)s,\n"
+                "  (mv_line.date_maturity + %(delay)s)::date <=\n"
+                "  date(%(controlling_date)s))\n"
+                " AND mv_line.date_maturity <= date(%(controlling_date)s))")
+
     @api.multi
     def _get_sql_date_boundary_for_computation_mode(self):
         """ Return a where clauses statement for the given controlling
         date and computation mode of the level
+
+        The clause comes from the registered computation mode, otherwise
+        from the ``_<mode>_get_boundary`` method of the level. None is
+        returned for the modes only evaluated in Python.
         """
         self.ensure_one()
+        mode = COMPUTATION_MODES.get(self.computation_mode)
+        if mode and mode.sql:
+            return mode.sql(self)
         fname = "_%s_get_boundary" % (self.computation_mode, )
         if hasattr(self, fname):
             fnc = getattr(self, fname)
             return fnc()
+        elif mode:
+            return None
         else:
             raise NotImplementedError(
                 _('Can not get function for computation mode: '
                   '%s is not implemented') % (fname, )
             )
 
+    @api.multi
+    def _get_sql_date_boundary(self, controlling_date, lines=None):
+        """ Return the where clause of the date boundary of the level
+        with its parameters bound, so it can be combined with the ones
+        of other levels in a single query.
+
+        For a mode only evaluated in Python, the clause restricts the move
+        lines to the ones reaching the boundary among ``lines``, by
+        default the move lines the policy processes.
+        """
+        self.ensure_one()
+        clause = self._get_sql_date_boundary_for_computation_mode()
+        if clause is None:
+            if lines is None:
+                lines = self.policy_id._get_move_lines_to_process(
+                    controlling_date)
+            line_ids = self._get_python_date_boundary_lines(
+                controlling_date, lines)
+            clause = "mv_line.id = ANY(%(line_ids)s::integer[])"
+            data_dict = {'line_ids': line_ids}
+        else:
+            data_dict = self._get_sql_date_boundary_params(controlling_date)
+        return self.env.cr.mogrify(clause, data_dict).decode('utf-8')
+
+    @api.multi
+    def _get_sql_date_boundary_params(self, controlling_date):
+        """ Return the parameters of the date boundary of the level """
+        self.ensure_one()
+        data_dict = {'controlling_date': controlling_date,
+                     'delay': self.delay_days}
+        mode = COMPUTATION_MODES.get(self.computation_mode)
+        if mode and mode.params:
+            data_dict.update(mode.params(self))
+        return data_dict
+
+    @api.multi
+    def _get_python_date_boundary_lines(self, controlling_date, lines):
+        """ Evaluate the date boundary of the level in Python on the
+        maturity dates and previous reminder dates of all the move lines
+        at once
+
+        :return: list of the ids of the move lines reaching the boundary
+        """
+        self.ensure_one()
+        if not lines:
+            return []
+        mode = COMPUTATION_MODES[self.computation_mode]
+        cr = self.env.cr
+        with ids_condition(cr, 'mv_line.id', lines.ids,
+                           'line_ids') as (condition, params):
+            query = sql.SQL(
+                "SELECT mv_line.id, mv_line.date_maturity,\n"
+                "       cr_line.date\n"
+                " FROM account_move_line mv_line\n"
+                " LEFT JOIN credit_control_line cr_line\n"
+                "   ON (cr_line.id = mv_line.credit_control_line_id)\n"
+                " WHERE {}"
+            ).format(condition)
+            cr.execute(query, params)
+            rows = cr.fetchall()
+        if not rows:
+            return []
+        line_ids, maturity_dates, previous_dates = zip(*rows)
+        reached = mode.evaluator(self, fields.Date.to_date(controlling_date),
+                                 list(maturity_dates), list(previous_dates))
+        return [line_id for line_id, is_reached in zip(line_ids, reached)
+                if is_reached]
+
     # -----------------------------------------
 
     @api.multi
@@ -342,26 +600,27 @@ class CreditControlPolicyLevel(models.Model):
         if not lines:
             return move_line_obj
         cr = self.env.cr
-        sql = ("SELECT DISTINCT mv_line.id\n"
-               " FROM account_move_line mv_line\n"
-               " WHERE mv_line.id in %(line_ids)s\n"
-               " AND NOT EXISTS (SELECT id\n"
-               "                 FROM credit_control_line\n"
-               "                 WHERE move_line_id = mv_line.id\n"
-               # lines from a previous level with a draft or ignored state
-               # or manually overridden
-               # have to be generated again for the previous level
-               "                 AND NOT manually_overridden\n"
-               "                 AND state NOT IN ('draft', 'ignored'))"
-               " AND (mv_line.debit IS NOT NULL AND mv_line.debit != 0.0)\n")
-        sql += " AND"
-        _get_sql_date_part = self._get_sql_date_boundary_for_computation_mode
-        sql += _get_sql_date_part()
-        data_dict = {'controlling_date': controlling_date,
-                     'line_ids': tuple(lines.ids),
-                     'delay': self.delay_days}
-        cr.execute(sql, data_dict)
-        res = cr.fetchall()
+        data_dict = {}
+        with ids_condition(cr, 'mv_line.id', lines.ids,
+                           'line_ids') as (condition, params):
+            boundary = self._get_sql_date_boundary(controlling_date,
+                                                   lines=lines)
+            query = sql.SQL(
+                "SELECT DISTINCT mv_line.id\n"
+                " FROM account_move_line mv_line\n"
+                " WHERE {condition}\n"
+                # lines from a previous level with a draft or ignored
+                # state or manually overridden
+                # have to be generated again for the previous level
+                " AND mv_line.credit_control_reminded IS NOT TRUE\n"
+                " AND (mv_line.debit IS NOT NULL\n"
+                "      AND mv_line.debit != 0.0)\n"
+                " AND {boundary}"
+            ).format(condition=condition,
+                     boundary=sql.SQL(boundary.replace('%', '%%')))
+            data_dict.update(params)
+            cr.execute(query, data_dict)
+            res = cr.fetchall()
         if res:
             return move_line_obj.browse([row[0] for row in res])
         return move_line_obj
@@ -376,36 +635,35 @@ class CreditControlPolicyLevel(models.Model):
         if not lines:
             return move_line_obj
         cr = self.env.cr
-        sql = ("SELECT mv_line.id\n"
-               " FROM account_move_line mv_line\n"
-               " JOIN credit_control_line cr_line\n"
-               " ON (mv_line.id = cr_line.move_line_id)\n"
-               " WHERE cr_line.id = (SELECT credit_control_line.id "
-               " FROM credit_control_line\n"
-               "      WHERE credit_control_line.move_line_id = mv_line.id\n"
-               "      AND state != 'ignored'"
-               "      AND NOT manually_overridden"
-               "      ORDER BY credit_control_line.level desc limit 1)\n"
-               " AND cr_line.level = %(previous_level)s\n"
-               " AND (mv_line.debit IS NOT NULL AND mv_line.debit != 0.0)\n"
-               # lines from a previous level with a draft or ignored state
-               # or manually overridden
-               # have to be generated again for the previous level
-               " AND NOT manually_overridden\n"
-               " AND cr_line.state NOT IN ('draft', 'ignored')\n"
-               " AND mv_line.id in %(line_ids)s\n")
-        sql += " AND "
-        _get_sql_date_part = self._get_sql_date_boundary_for_computation_mode
-        sql += _get_sql_date_part()
         previous_level = self._previous_level()
-        data_dict = {'controlling_date': controlling_date,
-                     'line_ids': tuple(lines.ids),
-                     'delay': self.delay_days,
-                     'previous_level': previous_level.level}
-
-        # print cr.mogrify(sql, data_dict)
-        cr.execute(sql, data_dict)
-        res = cr.fetchall()
+        data_dict = {'previous_level': previous_level.level}
+        with ids_condition(cr, 'mv_line.id', lines.ids,
+                           'line_ids') as (condition, params):
+            boundary = self._get_sql_date_boundary(controlling_date,
+                                                   lines=lines)
+            query = sql.SQL(
+                "SELECT mv_line.id\n"
+                " FROM account_move_line mv_line\n"
+                # current credit line of the move line, ignored or
+                # manually overridden lines are not taken into account
+                " JOIN credit_control_line cr_line\n"
+                " ON (cr_line.id = mv_line.credit_control_line_id)\n"
+                " WHERE mv_line.credit_control_level =\n"
+                "       %(previous_level)s\n"
+                " AND (mv_line.debit IS NOT NULL\n"
+                "      AND mv_line.debit != 0.0)\n"
+                # lines from a previous level with a draft or ignored
+                # state or manually overridden
+                # have to be generated again for the previous level
+                " AND mv_line.credit_control_state\n"
+                "     NOT IN ('draft', 'ignored')\n"
+                " AND {condition}\n"
+                " AND {boundary}"
+            ).format(condition=condition,
+                     boundary=sql.SQL(boundary.replace('%', '%%')))
+            data_dict.update(params)
+            cr.execute(query, data_dict)
+            res = cr.fetchall()
         if res:
             return move_line_obj.browse([row[0] for row in res])
         return move_line_obj
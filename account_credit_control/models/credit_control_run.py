@@ -2,8 +2,21 @@
 # Copyright 2017 Okia SPRL (https://okia.be)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from psycopg2 import sql
+
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
+from odoo.tools import config
+from odoo.tools.misc import formatLang, html_escape
+from .sql_ids import ids_condition
+
+_logger = logging.getLogger(__name__)
 
 
 class CreditControlRun(models.Model):
@@ -37,6 +50,10 @@ class CreditControlRun(models.Model):
         readonly=True,
         copy=False,
     )
+    preview = fields.Html(
+        readonly=True,
+        copy=False,
+    )
     state = fields.Selection(
         selection=[
             ('draft', 'Draft'),
@@ -74,6 +91,44 @@ class CreditControlRun(models.Model):
             'account.account'),
         index=True,
     )
+    incremental = fields.Boolean(
+        readonly=True,
+        states={'draft': [('readonly', False)]},
+        help="Only evaluate the move lines which may have changed of "
+             "level since the previous run: the lines modified since then, "
+             "the lines whose date boundary has been crossed between both "
+             "controlling dates and the lines whose credit lines changed "
+             "of state.",
+    )
+    watermark = fields.Datetime(
+        readonly=True,
+        copy=False,
+        help="Start of the generation of the lines, the next incremental "
+             "run evaluates the changes made after it.",
+    )
+    checkpoint_policy_id = fields.Many2one(
+        comodel_name='credit.control.policy',
+        string='Checkpoint Policy',
+        readonly=True,
+        copy=False,
+        help="Policy being processed when the last batch of partners "
+             "has been committed.",
+    )
+    checkpoint_partner_id = fields.Many2one(
+        comodel_name='res.partner',
+        string='Checkpoint Partner',
+        readonly=True,
+        copy=False,
+        help="Last partner processed for the checkpoint policy. An "
+             "interrupted run resumes after this partner.",
+    )
+    stat_ids = fields.One2many(
+        comodel_name='credit.control.run.stat',
+        inverse_name='run_id',
+        string='Statistics',
+        readonly=True,
+        copy=False,
+    )
 
     def _compute_credit_control_count(self):
         fetch_data = self.env['credit.control.line'].read_group(
@@ -112,6 +167,393 @@ class CreditControlRun(models.Model):
                   'recent than %s exists at %s') % (
                     controlling_date, lines.date))
 
+    @api.multi
+    def _get_run_workers(self):
+        """ Number of workers generating the credit lines in parallel
+
+        Every worker opens its own connection from the connection pool of
+        the Odoo process, so they are limited to half of the pool to leave
+        connections to the other requests.
+        """
+        self.ensure_one()
+        company = self.company_id or self.env.user.company_id
+        return max(min(company.credit_control_run_workers,
+                       config['db_maxconn'] // 2), 1)
+
+    @api.multi
+    def _get_previous_run(self):
+        """ Return the last done run of the company used as reference by
+        an incremental run
+        """
+        self.ensure_one()
+        return self.search([
+            ('id', '!=', self.id),
+            ('state', '=', 'done'),
+            ('company_id', '=', self.company_id.id),
+            ('date', '<=', self.date),
+            ('watermark', '!=', False),
+        ], order='date DESC, watermark DESC', limit=1)
+
+    @api.multi
+    @api.returns('account.move.line')
+    def _filter_changed_move_lines(self, policy, lines, previous_date,
+                                   watermark):
+        """ Keep the move lines which may have changed of level since a
+        previous run.
+
+        A move line is kept when it or one of its credit lines has been
+        written after the watermark, when the date boundary of a level of
+        the policy has been crossed between the previous controlling date
+        and the date of this run, or when its current credit line is a
+        draft, as the draft lines are generated again by every run.
+
+        :param policy: credit.control.policy record
+        :param lines: recordset of move lines to process for the policy
+        :param previous_date: controlling date of the previous run
+        :param watermark: datetime the previous run started at
+        """
+        self.ensure_one()
+        move_line_obj = self.env['account.move.line']
+        if not lines:
+            return move_line_obj
+        crossings = []
+        for level in policy.level_ids:
+            # the boundaries are rendered with their parameters
+            crossings.append(sql.SQL("OR (NOT ({}) AND ({}))\n").format(
+                sql.SQL(level._get_sql_date_boundary(
+                    previous_date, lines=lines).replace('%', '%%')),
+                sql.SQL(level._get_sql_date_boundary(
+                    self.date, lines=lines).replace('%', '%%')),
+            ))
+        cr = self.env.cr
+        with ids_condition(cr, 'mv_line.id', lines.ids,
+                           'line_ids') as (condition, params):
+            query = sql.SQL(
+                "SELECT mv_line.id\n"
+                " FROM account_move_line mv_line\n"
+                " LEFT JOIN credit_control_line cr_line\n"
+                "   ON (cr_line.id = mv_line.credit_control_line_id)\n"
+                " WHERE {condition}\n"
+                " AND (mv_line.write_date > %(watermark)s\n"
+                "      OR mv_line.date_maturity > %(previous_date)s\n"
+                "      OR mv_line.credit_control_state = 'draft'\n"
+                "      OR EXISTS (SELECT id FROM credit_control_line\n"
+                "                 WHERE move_line_id = mv_line.id\n"
+                "                 AND write_date > %(watermark)s)\n"
+                "      {crossings})"
+            ).format(condition=condition,
+                     crossings=sql.SQL('      ').join(crossings))
+            params.update(previous_date=previous_date, watermark=watermark)
+            cr.execute(query, params)
+            rows = cr.fetchall()
+        return move_line_obj.browse([row[0] for row in rows])
+
+    @api.model
+    def _is_policy_changed(self, policy, lines, watermark):
+        """ Tell whether the configuration giving the levels of the move
+        lines of a policy has been written after the watermark of a
+        previous run
+
+        The configuration is made of the policy, its levels, their
+        business calendars and the calendars of the countries of the
+        partners of the move lines, and of the company whose tolerance and
+        currency are applied (see ``credit.control.line._get_tolerances``).
+
+        :param policy: credit.control.policy record
+        :param lines: recordset of move lines to process for the policy
+        :param watermark: datetime the previous run started at
+        """
+        levels = policy.level_ids
+        calendars = levels.mapped('business_calendar_id')
+        if calendars:
+            countries = lines.mapped('partner_id.country_id')
+            calendars |= calendars.search([
+                ('country_id', 'in', countries.ids),
+            ])
+        company = self.env.user.company_id
+        # the records are of different models, they cannot be united
+        return any(record.write_date > watermark
+                   for records in (policy, levels, calendars, company)
+                   for record in records)
+
+    @api.multi
+    @api.returns('account.move.line')
+    def _get_policy_move_lines(self, policy):
+        """ Return the move lines to process by the run for a policy,
+        restricted to the changed ones for an incremental run
+        """
+        self.ensure_one()
+        with self._run_phase('move_lines', policy=policy) as stat:
+            lines = policy._get_move_lines_to_process(self.date)
+            stat['rows'] = len(lines)
+        if not self.incremental:
+            return lines
+        previous_run = self._get_previous_run()
+        if policy not in previous_run.policy_ids:
+            return lines
+        # a change in the configuration of the policy may move any line
+        if self._is_policy_changed(policy, lines, previous_run.watermark):
+            return lines
+        with self._run_phase('incremental', policy=policy) as stat:
+            lines = self._filter_changed_move_lines(
+                policy, lines, previous_run.date, previous_run.watermark)
+            stat['rows'] = len(lines)
+        return lines
+
+    @api.multi
+    @contextmanager
+    def _run_phase(self, phase, policy=None, level=None):
+        """ Measure a phase of the generation of the credit lines
+
+        The wall time and the number of SQL queries of the phase are
+        recorded on the run with the number of rows the phase stores in
+        the yielded dict under the ``rows`` key.
+
+        :param str phase: key of the phase, see ``credit.control.run.stat``
+        :param policy: credit.control.policy record processed by the phase
+        :param level: credit.control.policy.level record processed by the
+            phase
+        """
+        self.ensure_one()
+        cr = self.env.cr
+        stat = {'rows': 0}
+        queries = getattr(cr, 'sql_log_count', 0)
+        start = time.time()
+        yield stat
+        vals = {
+            'run_id': self.id,
+            'phase': phase,
+            'policy_id': policy.id if policy else False,
+            'level_id': level.id if level else False,
+            'duration': time.time() - start,
+            'query_count': getattr(cr, 'sql_log_count', 0) - queries,
+            'row_count': stat['rows'],
+        }
+        self.env['credit.control.run.stat'].create(vals)
+        self._export_phase_stat(vals)
+
+    @api.multi
+    def _export_phase_stat(self, vals):
+        """ Hook called with the statistics of every phase of the run,
+        to export them to a monitoring system
+
+        :param vals: dict of values of the ``credit.control.run.stat``
+        """
+        _logger.debug("Credit control run %s: phase %s of policy %s, "
+                      "level %s: %.3fs, %d queries, %d rows",
+                      vals['run_id'], vals['phase'], vals['policy_id'],
+                      vals['level_id'], vals['duration'],
+                      vals['query_count'], vals['row_count'])
+
+    @api.multi
+    def _generate_policy_lines(self, policy, lines):
+        """ Generate the credit control lines of a policy for move lines
+
+        :param policy: credit.control.policy record
+        :param lines: recordset of move lines to process for the policy
+        :return: tuple with the recordset of generated credit lines and
+            the recordset of move lines to handle manually
+        """
+        self.ensure_one()
+        with self._run_phase('different_policy', policy=policy) as stat:
+            manual_lines = policy._lines_different_policy(lines)
+            stat['rows'] = len(manual_lines)
+        lines -= manual_lines
+        generated = self.env['credit.control.line']
+        if lines:
+            # policy levels are sorted by level
+            # so iteration is in the correct order
+            create = generated.create_or_update_from_mv_lines
+            with self._run_phase('classification', policy=policy) as stat:
+                level_lines = policy._get_level_move_lines(self.date, lines)
+                stat['rows'] = sum(len(level_lines[level])
+                                   for level in level_lines)
+            for level in reversed(policy.level_ids):
+                with self._run_phase('creation', policy=policy,
+                                     level=level) as stat:
+                    level_generated = create(level_lines[level], level,
+                                             self.date)
+                    stat['rows'] = len(level_generated)
+                generated += level_generated
+        return generated, manual_lines
+
+    @api.multi
+    def _get_run_batch_size(self):
+        """ Number of partners processed between two commits, 0 when the
+        run is generated in a single transaction
+        """
+        self.ensure_one()
+        company = self.company_id or self.env.user.company_id
+        return max(company.credit_control_run_batch_size, 0)
+
+    @api.multi
+    def _commit_checkpoint(self):
+        """ Commit the work done so far so an interrupted run resumes from
+        its last checkpoint
+        """
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    @api.multi
+    def _generate_policies_lines_chunked(self, policies, batch_size):
+        """ Generate the credit lines of the policies per batch of partners
+
+        The work is committed after each batch and the checkpoint stored
+        on the run, a run which has been interrupted resumes after the
+        last partner committed.
+
+        :return: dict with the policies as keys and tuples of generated
+            credit lines and move lines to handle manually as values
+        """
+        self.ensure_one()
+        line_obj = self.env['credit.control.line']
+        move_line_obj = self.env['account.move.line']
+        checkpoint_policy = self.checkpoint_policy_id
+        checkpoint_partner_id = self.checkpoint_partner_id.id
+        results = {}
+        for policy in policies.sorted('id'):
+            manually_managed_lines = move_line_obj
+            if not checkpoint_policy or policy.id >= checkpoint_policy.id:
+                lines = self._get_policy_move_lines(policy)
+                lines_by_partner = {}
+                for line in lines:
+                    lines_by_partner.setdefault(
+                        line.partner_id.id, []).append(line.id)
+                partner_ids = sorted(lines_by_partner)
+                if policy == checkpoint_policy and checkpoint_partner_id:
+                    partner_ids = [partner_id for partner_id in partner_ids
+                                   if partner_id > checkpoint_partner_id]
+                for index in range(0, len(partner_ids), batch_size):
+                    batch = partner_ids[index:index + batch_size]
+                    batch_lines = move_line_obj.browse([
+                        line_id for partner_id in batch
+                        for line_id in lines_by_partner[partner_id]
+                    ])
+                    generated, manual_lines = self._generate_policy_lines(
+                        policy, batch_lines)
+                    generated.write({'run_id': self.id})
+                    manually_managed_lines |= manual_lines
+                    self.write({
+                        'manual_ids': [(4, line.id) for line in manual_lines],
+                        'checkpoint_policy_id': policy.id,
+                        'checkpoint_partner_id': batch[-1],
+                    })
+                    self._commit_checkpoint()
+            # include the lines committed by an interrupted execution
+            policy_lines_generated = line_obj.search([
+                ('run_id', '=', self.id),
+                ('policy_id', '=', policy.id),
+            ])
+            results[policy] = (policy_lines_generated, manually_managed_lines)
+        return results
+
+    @api.model
+    def _get_partner_shards(self, lines, nb_shards):
+        """ Split move lines in shards balanced on their number of lines,
+        the lines of a partner always belonging to the same shard
+
+        The partners having the most lines are assigned first, each one
+        to the shard having the fewest lines so far.
+
+        :return: list of lists of move line ids
+        """
+        lines_by_partner = {}
+        for line in lines:
+            lines_by_partner.setdefault(
+                line.partner_id.id, []).append(line.id)
+        shards = [[] for __ in range(nb_shards)]
+        for partner_id in sorted(
+                lines_by_partner,
+                key=lambda partner_id: (-len(lines_by_partner[partner_id]),
+                                        partner_id)):
+            shard = min(shards, key=len)
+            shard.extend(lines_by_partner[partner_id])
+        return [shard for shard in shards if shard]
+
+    @api.multi
+    def _generate_shard_lines(self, policy_id, line_ids):
+        """ Generate the credit lines of a shard in its own transaction
+
+        Called in a worker thread, so it works on a new cursor of the
+        connection pool which is committed when the shard is done. The
+        generated credit lines are linked to the run in the same
+        transaction, so they are never left without run.
+
+        :return: list of ids of the move lines to handle manually
+        """
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            run = self.with_env(env)
+            policy = env['credit.control.policy'].browse(policy_id)
+            lines = env['account.move.line'].browse(line_ids)
+            generated, manual_lines = run._generate_policy_lines(
+                policy, lines)
+            generated.write({'run_id': run.id})
+            return manual_lines.ids
+
+    @api.multi
+    def _generate_policies_lines_parallel(self, policies, workers):
+        """ Generate the credit lines of the policies in parallel
+
+        The move lines of each policy are split in shards on their
+        partner, every shard being generated in a worker thread with its
+        own cursor. A shard which fails is generated again in the current
+        transaction under a savepoint.
+
+        The run is committed before the shards, so the workers see it,
+        and after them, so the current transaction sees the credit lines
+        committed by the workers. The policies stay locked meanwhile, see
+        ``_lock_run``.
+
+        :return: dict with the policies as keys and tuples of generated
+            credit lines and move lines to handle manually as values
+        """
+        self.ensure_one()
+        line_obj = self.env['credit.control.line']
+        move_line_obj = self.env['account.move.line']
+        manual_lines = {policy: move_line_obj for policy in policies}
+        shards = []
+        for policy in policies:
+            lines = self._get_policy_move_lines(policy)
+            for line_ids in self._get_partner_shards(lines, workers):
+                shards.append((policy, line_ids))
+        self._commit_checkpoint()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._generate_shard_lines,
+                                policy.id, line_ids)
+                for policy, line_ids in shards
+            ]
+        # start a new transaction to see the shards committed by the
+        # workers
+        self._commit_checkpoint()
+        self.invalidate_cache()
+
+        for (policy, line_ids), future in zip(shards, futures):
+            try:
+                manual_ids = future.result()
+                manual_lines[policy] |= move_line_obj.browse(manual_ids)
+            except Exception:
+                _logger.exception(
+                    "Credit control run %s: shard of %d move lines of "
+                    "policy %s failed, generating it again",
+                    self.id, len(line_ids), policy.name)
+                with self.env.cr.savepoint():
+                    generated, shard_manual_lines = \
+                        self._generate_policy_lines(
+                            policy, move_line_obj.browse(line_ids))
+                    generated.write({'run_id': self.id})
+                manual_lines[policy] |= shard_manual_lines
+
+        results = {}
+        for policy in policies:
+            policy_lines_generated = line_obj.search([
+                ('run_id', '=', self.id),
+                ('policy_id', '=', policy.id),
+            ])
+            results[policy] = (policy_lines_generated, manual_lines[policy])
+        return results
+
     @api.multi
     @api.returns('credit.control.line')
     def _generate_credit_lines(self):
@@ -123,25 +565,31 @@ class CreditControlRun(models.Model):
         policies = self.policy_ids
         if not policies:
             raise UserError(_('Please select a policy'))
+        policies = policies.filtered(lambda p: not p.do_nothing)
+        if not self.watermark:
+            # transaction start, as used for the write dates of the records
+            self.env.cr.execute("SELECT now() at time zone 'UTC'")
+            self.watermark = self.env.cr.fetchone()[0]
+
+        workers = self._get_run_workers()
+        batch_size = self._get_run_batch_size()
+        if workers > 1:
+            results = self._generate_policies_lines_parallel(
+                policies, workers)
+        elif batch_size:
+            results = self._generate_policies_lines_chunked(
+                policies, batch_size)
+        else:
+            results = {}
+            for policy in policies:
+                lines = self._get_policy_move_lines(policy)
+                results[policy] = self._generate_policy_lines(policy, lines)
 
         report = ''
         generated = self.env['credit.control.line']
         for policy in policies:
-            if policy.do_nothing:
-                continue
-            lines = policy._get_move_lines_to_process(self.date)
-            manual_lines = policy._lines_different_policy(lines)
-            lines -= manual_lines
+            policy_lines_generated, manual_lines = results[policy]
             manually_managed_lines |= manual_lines
-            policy_lines_generated = self.env['credit.control.line']
-            if lines:
-                # policy levels are sorted by level
-                # so iteration is in the correct order
-                create = policy_lines_generated.create_or_update_from_mv_lines
-                for level in reversed(policy.level_ids):
-                    level_lines = level.get_level_lines(self.date, lines)
-                    policy_lines_generated += create(
-                        level_lines, level, self.date)
             generated |= policy_lines_generated
             if policy_lines_generated:
                 report += (_("Policy \"<b>%s</b>\" has generated <b>%d Credit "
@@ -152,32 +600,113 @@ class CreditControlRun(models.Model):
                     "Policy \"<b>%s</b>\" has not generated any "
                     "Credit Control Lines.<br/>") % policy.name
 
+        # keep the lines already linked by an interrupted execution
+        manually_managed_lines |= self.manual_ids
+        generated |= self.line_ids
         vals = {
             'state': 'done',
             'report': report,
             'manual_ids': [(6, 0, manually_managed_lines.ids)],
             'line_ids': [(6, 0, generated.ids)],
+            'checkpoint_policy_id': False,
+            'checkpoint_partner_id': False,
         }
         self.write(vals)
         return generated
 
+    @api.multi
+    def action_preview(self):
+        """ Show the credit lines the run would generate per policy and
+        level, without creating them
+        """
+        self.ensure_one()
+        policies = self.policy_ids.filtered(lambda p: not p.do_nothing)
+        if not policies:
+            raise UserError(_('Please select a policy'))
+        currency = (self.company_id or self.env.user.company_id).currency_id
+        rows = ''
+        for policy in policies:
+            for data in policy._get_preview_data(self.date):
+                rows += ("<tr><td>%s</td><td>%s</td>"
+                         "<td class=\"text-right\">%d</td>"
+                         "<td class=\"text-right\">%d</td>"
+                         "<td class=\"text-right\">%s</td></tr>") % (
+                    html_escape(policy.name),
+                    html_escape(data['level'].name),
+                    data['lines'],
+                    data['partners'],
+                    formatLang(self.env, data['amount'],
+                               currency_obj=currency),
+                )
+        self.preview = (
+            "<table class=\"table table-condensed\"><thead><tr>"
+            "<th>%s</th><th>%s</th>"
+            "<th class=\"text-right\">%s</th>"
+            "<th class=\"text-right\">%s</th>"
+            "<th class=\"text-right\">%s</th>"
+            "</tr></thead><tbody>%s</tbody></table>"
+        ) % (_('Policy'), _('Level'), _('Lines'), _('Partners'),
+             _('Open Amount'), rows)
+        return True
+
+    @api.model
+    def _get_lock_key(self, company, policy):
+        """ Key of the Postgres advisory lock of a policy for a company """
+        key = 'credit.control.run,%s,%s' % (company.id, policy.id)
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big', signed=True)
+
+    @api.multi
+    def _lock_run(self):
+        """ Lock the policies of the run for its company to avoid
+        concurrent runs on them
+
+        Postgres advisory locks are used, so the runs of other companies
+        or on other policies can be generated at the same time. They are
+        session locks, kept across the commits of a chunked or parallel
+        run until ``_unlock_run`` releases them.
+
+        :return: list of the keys of the locks
+        """
+        self.ensure_one()
+        company = self.company_id or self.env.user.company_id
+        keys = []
+        for policy in self.policy_ids.sorted('id'):
+            key = self._get_lock_key(company, policy)
+            self.env.cr.execute('SELECT pg_try_advisory_lock(%s)', (key, ))
+            if self.env.cr.fetchone()[0]:
+                keys.append(key)
+            else:
+                self._unlock_run(keys)
+                raise UserError(
+                    _('A credit control run is already running in '
+                      'background for the policy "%s" of the company '
+                      '"%s", please try later.')
+                    % (policy.name, company.name))
+
+    @api.model
+    def _unlock_run(self, keys):
+        """ Release the locks taken by ``_lock_run`` """
+        for key in keys:
+            self.env.cr.execute('SELECT pg_advisory_unlock(%s)', (key, ))
+
     @api.multi
     def generate_credit_lines(self):
         """ Generate credit control lines
 
-        Lock the ``credit_control_run`` Postgres table to avoid concurrent
-        calls of this method.
+        Lock the policies of the run for its company to avoid concurrent
+        calls of this method on them.
         """
+        keys = self._lock_run()
         try:
-            self.env.cr.execute('SELECT id FROM credit_control_run'
-                                ' LIMIT 1 FOR UPDATE NOWAIT')
+            self._generate_credit_lines()
         except Exception:
-            # In case of exception openerp will do a rollback
-            # for us and free the lock
-            raise UserError(_('A credit control run is already running '
-                              'in background, please try later.'))
-
-        self._generate_credit_lines()
+            # the session locks survive the rollback, which has to be done
+            # before the locks can be released by the failed transaction
+            self.env.cr.rollback()
+            raise
+        finally:
+            self._unlock_run(keys)
         return True
 
     def unlink(self):
@@ -196,8 +725,7 @@ class CreditControlRun(models.Model):
 
     def set_to_ready_lines(self):
         self.ensure_one()
-        draft_lines = self.line_ids.filtered(lambda x: x.state == 'draft')
-        draft_lines.write({'state': 'to_be_sent'})
+        self.line_ids._set_state('to_be_sent', from_states=('draft',))
         self.hide_change_state_button = True
 
     def run_channel_action(self):
@@ -207,10 +735,56 @@ class CreditControlRun(models.Model):
         email_lines = lines.filtered(lambda x: x.channel == 'email')
         if email_lines:
             comm_obj = self.env['credit.control.communication']
-            comms = comm_obj._generate_comm_from_credit_lines(email_lines)
-            comms._generate_emails()
+            comm_obj._generate_emails_from_credit_lines(email_lines)
         if letter_lines:
             wiz = self.env['credit.control.printer'].create({
                 'line_ids': letter_lines.ids,
             })
             return wiz.print_lines
+
+
+class CreditControlRunStat(models.Model):
+    """ Statistics of a phase of the generation of a credit control run """
+
+    _name = "credit.control.run.stat"
+    _description = "Credit control run statistics"
+    _order = "run_id, id"
+
+    run_id = fields.Many2one(
+        comodel_name='credit.control.run',
+        string='Run',
+        required=True,
+        ondelete='cascade',
+        index=True,
+    )
+    policy_id = fields.Many2one(
+        comodel_name='credit.control.policy',
+        string='Policy',
+        ondelete='set null',
+    )
+    level_id = fields.Many2one(
+        comodel_name='credit.control.policy.level',
+        string='Level',
+        ondelete='set null',
+    )
+    phase = fields.Selection(
+        selection=[
+            ('move_lines', 'Move lines to process'),
+            ('incremental', 'Changed move lines'),
+            ('different_policy', 'Lines of another policy'),
+            ('classification', 'Level classification'),
+            ('creation', 'Credit lines creation'),
+        ],
+        required=True,
+    )
+    duration = fields.Float(
+        string='Duration (s)',
+        digits=(16, 3),
+    )
+    query_count = fields.Integer(
+        string='SQL Queries',
+    )
+    row_count = fields.Integer(
+        string='Rows',
+        help="Number of move lines or credit lines handled by the phase.",
+    )
@@ -1,7 +1,17 @@
 # Copyright 2012-2017 Camptocamp SA
 # Copyright 2017 Okia SPRL (https://okia.be)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from odoo import fields, models
+import functools
+import logging
+import smtplib
+from datetime import timedelta
+
+from psycopg2 import sql
+
+from odoo import api, fields, models, tools
+from . import smtp_pool
+
+_logger = logging.getLogger(__name__)
 
 
 class Mail(models.Model):
@@ -11,3 +21,293 @@ class Mail(models.Model):
         string='Rich-text Contents',
         help="Rich-text/HTML message",
     )
+    credit_control_queued = fields.Boolean(
+        string='Credit Control Queue',
+        index=True,
+        readonly=True,
+        help="Sent by the credit control dispatch queue instead of the "
+             "generic email queue.",
+    )
+    credit_control_retry_count = fields.Integer(
+        string='Delivery Attempts',
+        readonly=True,
+    )
+    credit_control_next_try = fields.Datetime(
+        string='Next Delivery Attempt',
+        readonly=True,
+    )
+
+    @api.multi
+    def _link_attachments(self, attachments):
+        """ Attach attachments to the emails designated by their ``res_id``
+        with a single query
+        """
+        message_ids = {email.id: email.mail_message_id.id for email in self}
+        rows = [(message_ids[att.res_id], att.id) for att in attachments
+                if att.res_model == self._name and att.res_id in message_ids]
+        if not rows:
+            return
+        message_ids, attachment_ids = zip(*rows)
+        field = self.env['mail.message']._fields['attachment_ids']
+        query = sql.SQL(
+            "INSERT INTO {} ({}, {})"
+            " SELECT * FROM unnest(%s::integer[], %s::integer[])"
+        ).format(sql.Identifier(field.relation),
+                 sql.Identifier(field.column1),
+                 sql.Identifier(field.column2))
+        self.env.cr.execute(query, (list(message_ids), list(attachment_ids)))
+        self.env['mail.message'].invalidate_cache(['attachment_ids'])
+        self.invalidate_cache(['attachment_ids'])
+
+    @api.model
+    def process_email_queue(self, ids=None):
+        """ Leave the emails of the credit control queue to its dispatcher """
+        filters = list(self.env.context.get('filters') or [])
+        filters.append(('credit_control_queued', '=', False))
+        return super(Mail, self.with_context(filters=filters)
+                     ).process_email_queue(ids=ids)
+
+    @api.model
+    def _get_credit_control_queue_params(self):
+        """ Read the settings of the credit control dispatch queue
+
+        :return: dict with the ``batch_size``, the ``max_retries``, the
+            ``retry_delay`` in minutes, the default ``domain_limit`` and
+            the specific ``domain_limits`` of the recipient domains per
+            ``domain_window`` in minutes, and the ``connection_max_idle``
+            seconds of the pooled SMTP connections
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        prefix = 'account_credit_control.email_queue_'
+        domain_limits = {}
+        for item in (get_param(prefix + 'domain_limits') or '').split(','):
+            if ':' in item:
+                domain, limit = item.rsplit(':', 1)
+                domain_limits[domain.strip().lower()] = int(limit)
+        return {
+            'batch_size': int(get_param(prefix + 'batch_size', 500)),
+            'max_retries': int(get_param(prefix + 'max_retries', 5)),
+            'retry_delay': int(get_param(prefix + 'retry_delay', 5)),
+            'domain_limit': int(get_param(prefix + 'domain_limit', 0)),
+            'domain_limits': domain_limits,
+            'domain_window': int(get_param(prefix + 'domain_window', 60)),
+            'connection_max_idle': int(
+                get_param(prefix + 'connection_max_idle', 600)),
+        }
+
+    @api.multi
+    def _get_recipient_domain(self):
+        """ Domain of the first recipient of the email """
+        self.ensure_one()
+        emails = tools.email_split(self.email_to or '')
+        emails += [partner.email for partner in self.recipient_ids
+                   if partner.email]
+        if not emails:
+            return ''
+        return emails[0].rsplit('@', 1)[-1].lower()
+
+    @api.multi
+    def _filter_domain_limits(self, params):
+        """ Keep the emails which can be sent without exceeding the number
+        of emails per recipient domain and time window
+
+        The emails kept are counted on the window of their domain, so the
+        limits hold across the executions of the queue.
+        """
+        domain_obj = self.env['credit.control.mail.domain']
+        domains = {mail.id: mail._get_recipient_domain() for mail in self}
+        counters = domain_obj._get_counters(
+            {domain for domain in domains.values() if domain},
+            params['domain_window'])
+        counts = {counter.name: counter.sent_count for counter in counters}
+        mail_ids = []
+        for mail in self:
+            domain = domains[mail.id]
+            # the emails without recipient fail without reaching a domain
+            if domain:
+                limit = params['domain_limits'].get(domain,
+                                                    params['domain_limit'])
+                if limit and counts[domain] >= limit:
+                    continue
+                counts[domain] += 1
+            mail_ids.append(mail.id)
+        for counter in counters:
+            if counts[counter.name] != counter.sent_count:
+                counter.sent_count = counts[counter.name]
+        return self.browse(mail_ids)
+
+    @api.model
+    def _get_credit_control_smtp_key(self, server_id):
+        """ Key of the pooled SMTP connections of a mail server, changed by
+        a modification of the server
+        """
+        server = self.env['ir.mail_server'].browse(server_id)
+        return self.env.cr.dbname, server.id, server.write_date
+
+    @api.model
+    def process_credit_control_queue(self):
+        """ Send the emails of the credit control queue, cron entry point
+
+        The emails are sent per mail server on an SMTP connection of the
+        pool, kept open between the executions, within the limits of emails
+        per recipient domain. The outcome of the delivery is reported on
+        the credit control lines by ``_postprocess_sent_message``.
+        """
+        params = self._get_credit_control_queue_params()
+        mails = self.search([
+            ('credit_control_queued', '=', True),
+            ('state', '=', 'outgoing'),
+            '|',
+            ('credit_control_next_try', '=', False),
+            ('credit_control_next_try', '<=', fields.Datetime.now()),
+        ], limit=params['batch_size'], order='id')
+        mails = mails._filter_domain_limits(params)
+        mail_ids_by_server = {}
+        for mail in mails:
+            mail_ids_by_server.setdefault(mail.mail_server_id.id,
+                                          []).append(mail.id)
+        mail_server_obj = self.env['ir.mail_server']
+        for server_id, mail_ids in mail_ids_by_server.items():
+            server_mails = self.browse(mail_ids)
+            key = self._get_credit_control_smtp_key(server_id)
+            try:
+                smtp_session = smtp_pool.acquire(
+                    key,
+                    functools.partial(mail_server_obj.connect,
+                                      mail_server_id=server_id),
+                    params['connection_max_idle'])
+            except Exception as exc:
+                _logger.warning("Credit control queue: could not connect "
+                                "to the mail server: %s", exc)
+                server_mails._credit_control_fail(tools.ustr(exc))
+                continue
+            try:
+                server_mails._send(smtp_session=smtp_session)
+            except smtplib.SMTPServerDisconnected as exc:
+                _logger.exception("Credit control queue: the mail server "
+                                  "closed the connection")
+                smtp_pool.discard(smtp_session)
+                # the emails not sent yet count an attempt
+                server_mails.filtered(
+                    lambda mail: mail.state == 'outgoing'
+                )._credit_control_fail(tools.ustr(exc))
+            except Exception:
+                smtp_pool.discard(smtp_session)
+                raise
+            else:
+                smtp_pool.release(key, smtp_session)
+        return True
+
+    @api.multi
+    def _credit_control_fail(self, failure_reason):
+        """ Record a failed delivery attempt of emails of the credit control
+        queue because of the mail server
+
+        The emails are scheduled for a new attempt, or set in exception
+        once they reach the maximum number of attempts.
+        """
+        if not self:
+            return
+        self.write({
+            'state': 'exception',
+            'failure_reason': failure_reason,
+        })
+        self._postprocess_sent_message(
+            success_pids=[], failure_reason=failure_reason,
+            failure_type='SMTP')
+
+    @api.multi
+    def _postprocess_sent_message(self, success_pids, failure_reason=False,
+                                  failure_type=None):
+        """ Report the delivery of the emails of the credit control queue on
+        their credit lines, and schedule a new attempt of the failed ones
+        before they may be deleted
+        """
+        queued = self.filtered('credit_control_queued')
+        if queued:
+            queued._credit_control_postprocess(failure_type)
+        return super(Mail, self)._postprocess_sent_message(
+            success_pids, failure_reason=failure_reason,
+            failure_type=failure_type)
+
+    @api.multi
+    def _credit_control_postprocess(self, failure_type):
+        params = self._get_credit_control_queue_params()
+        line_obj = self.env['credit.control.line']
+        sent = self.filtered(lambda mail: mail.state == 'sent')
+        failed = self - sent
+        # the recipients are refused, a new attempt would fail again
+        final = failed if failure_type == 'RECIPIENT' else failed.filtered(
+            lambda mail: mail.credit_control_retry_count + 1 >=
+            params['max_retries'])
+        now = fields.Datetime.now()
+        for mail in failed - final:
+            retry_count = mail.credit_control_retry_count + 1
+            delay = params['retry_delay'] * 2 ** (retry_count - 1)
+            mail.write({
+                'state': 'outgoing',
+                'credit_control_retry_count': retry_count,
+                'credit_control_next_try': now + timedelta(minutes=delay),
+            })
+        # the failed emails stay in the credit control queue, so the
+        # generic queue never sends them without the retry delays
+        final.filtered(lambda mail: mail.state != 'exception').write({
+            'state': 'exception',
+        })
+        sent.write({'credit_control_queued': False})
+        for mails, state in ((sent, 'sent'), (final, 'email_error')):
+            if not mails:
+                continue
+            lines = line_obj.search([
+                ('mail_message_id', 'in', mails.ids),
+                ('state', '=', 'queued'),
+            ])
+            lines._set_state(state, from_states=('queued',),
+                             summary=False)
+
+
+class CreditControlMailDomain(models.Model):
+    """ Emails sent by the credit control queue to a recipient domain
+    during a time window
+    """
+
+    _name = "credit.control.mail.domain"
+    _description = "Credit control emails per recipient domain"
+
+    name = fields.Char(
+        string='Domain',
+        required=True,
+        index=True,
+    )
+    window_start = fields.Datetime(
+        required=True,
+    )
+    sent_count = fields.Integer(
+        string='Sent Emails',
+    )
+
+    _sql_constraints = [
+        ('name_uniq', 'unique (name)',
+         'The recipient domain must be unique.'),
+    ]
+
+    @api.model
+    def _get_counters(self, domains, window):
+        """ Return the counters of the recipient domains, the counters of
+        the windows started more than ``window`` minutes ago being reset
+
+        :param domains: iterable of recipient domains
+        :param window: duration of the windows in minutes
+        """
+        counters = self.search([('name', 'in', list(domains))])
+        now = fields.Datetime.now()
+        counters.filtered(
+            lambda counter: counter.window_start + timedelta(
+                minutes=window) <= now
+        ).write({'window_start': now, 'sent_count': 0})
+        missing = set(domains) - set(counters.mapped('name'))
+        counters |= self.create([{
+            'name': domain,
+            'window_start': now,
+        } for domain in missing])
+        return counters
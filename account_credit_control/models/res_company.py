@@ -1,7 +1,7 @@
 # Copyright 2012-2017 Camptocamp SA
 # Copyright 2017 Okia SPRL (https://okia.be)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class ResCompany(models.Model):
@@ -23,3 +23,61 @@ class ResCompany(models.Model):
              "This setting can be overridden"
              " on partners or invoices.",
     )
+    credit_control_run_workers = fields.Integer(
+        string='Credit Control Run Workers',
+        default=1,
+        help="Number of workers generating the credit control lines of a "
+             "run in parallel. The move lines are split in shards per "
+             "policy and partner, each shard being processed on its own "
+             "database cursor.",
+    )
+    credit_control_run_batch_size = fields.Integer(
+        string='Credit Control Run Batch Size',
+        help="Number of partners processed by a credit control run "
+             "between two commits. An interrupted run resumes from its "
+             "last commit. Leave empty to generate a run in a single "
+             "transaction.",
+    )
+    credit_control_report_workers = fields.Integer(
+        string='Credit Control Report Workers',
+        default=1,
+        help="Number of wkhtmltopdf processes rendering the letters "
+             "exported by the credit control printer in parallel. The "
+             "communications are split in chunks whose PDF files are "
+             "written on the disk and appended to the exported file.",
+    )
+
+    @api.multi
+    def _write(self, vals):
+        # ``_write`` rather than ``write``: the imports and the low-level
+        # writes change the policy of the move lines too
+        res = super(ResCompany, self)._write(vals)
+        if 'credit_policy_id' in vals:
+            self._update_move_lines_credit_policy()
+        return res
+
+    @api.multi
+    def _update_move_lines_credit_policy(self):
+        """ Apply the policy of the companies on their move lines having
+        neither an invoice policy nor a partner policy, in one query
+        """
+        if not self:
+            return
+        self.env.cr.execute(
+            "UPDATE account_move_line mv_line\n"
+            " SET credit_policy_id = company.credit_policy_id\n"
+            " FROM res_company company\n"
+            " WHERE company.id = mv_line.company_id\n"
+            " AND company.id IN %s\n"
+            " AND mv_line.credit_policy_id IS DISTINCT FROM\n"
+            "     company.credit_policy_id\n"
+            " AND NOT EXISTS (\n"
+            "   SELECT id FROM account_invoice inv\n"
+            "   WHERE inv.id = mv_line.invoice_id\n"
+            "   AND inv.credit_policy_id IS NOT NULL)\n"
+            " AND NOT EXISTS (\n"
+            "   SELECT id FROM res_partner partner\n"
+            "   WHERE partner.id = mv_line.partner_id\n"
+            "   AND partner.credit_policy_id IS NOT NULL)",
+            (tuple(self.ids), ))
+        self.env['account.move.line'].invalidate_cache(['credit_policy_id'])
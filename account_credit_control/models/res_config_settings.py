@@ -23,3 +23,15 @@ class ResConfigSettings(models.TransientModel):
              "This setting can be overridden"
              " on partners or invoices.",
     )
+    credit_control_run_workers = fields.Integer(
+        related="company_id.credit_control_run_workers",
+        readonly=False,
+    )
+    credit_control_run_batch_size = fields.Integer(
+        related="company_id.credit_control_run_batch_size",
+        readonly=False,
+    )
+    credit_control_report_workers = fields.Integer(
+        related="company_id.credit_control_report_workers",
+        readonly=False,
+    )
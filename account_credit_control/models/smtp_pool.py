@@ -0,0 +1,55 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import smtplib
+import threading
+import time
+
+_lock = threading.Lock()
+# idle SMTP sessions with the time they were released, per key
+_sessions = {}
+
+
+def _is_alive(session):
+    try:
+        return session.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def discard(session):
+    """ Close an SMTP session instead of giving it back to the pool """
+    try:
+        session.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
+
+
+def acquire(key, connect, max_idle):
+    """ Take an SMTP session of the pool
+
+    The idle sessions of the key are reused when they have been idle for
+    less than ``max_idle`` seconds and the server still answers, otherwise
+    a new session is opened.
+
+    :param key: hashable identifying the mail server of the sessions
+    :param connect: callable opening a new session
+    :param max_idle: seconds an idle session is kept in the pool
+    """
+    while True:
+        with _lock:
+            idle = _sessions.get(key)
+            if not idle:
+                break
+            session, released_at = idle.pop()
+        if time.time() - released_at < max_idle and _is_alive(session):
+            return session
+        discard(session)
+    return connect()
+
+
+def release(key, session):
+    """ Give an SMTP session taken with ``acquire`` back to the pool """
+    if session is None:
+        return
+    with _lock:
+        _sessions.setdefault(key, []).append((session, time.time()))
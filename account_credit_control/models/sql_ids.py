@@ -0,0 +1,64 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import io
+import itertools
+from contextlib import contextmanager
+
+from psycopg2 import sql
+
+# up to this number of ids, they are given as a list of literals
+IN_MAX_IDS = 1000
+# up to this number of ids, they are given as a single array literal,
+# above they are copied in a temporary table
+ARRAY_MAX_IDS = 100000
+
+_table_sequence = itertools.count()
+
+
+def _column_identifier(column):
+    return sql.SQL('.').join(
+        sql.Identifier(part) for part in column.split('.'))
+
+
+@contextmanager
+def ids_condition(cr, column, ids, name='ids'):
+    """ Build the condition restricting a column to a set of ids
+
+    A few ids are given as ``column IN (...)``. A larger set is given as a
+    single array parameter, which is parsed much faster than a list of
+    literals. A huge set is copied in a temporary table the condition
+    selects from, so the planner can use a semi-join with statistics.
+    The temporary table is dropped when leaving the context, or by a
+    commit in the context, after which the condition cannot be used.
+
+    :param cr: database cursor
+    :param str column: qualified name of the column, e.g. ``mv_line.id``
+    :param ids: iterable of ids
+    :param str name: name of the parameter used in the condition
+    :return: the condition, a ``psycopg2.sql.Composable`` to compose in
+        the query, and a dict with its parameter, to merge with the
+        parameters of the query
+    """
+    ids = list(ids)
+    column = _column_identifier(column)
+    if len(ids) <= IN_MAX_IDS:
+        yield (sql.SQL("{} IN {}").format(column, sql.Placeholder(name)),
+               {name: tuple(ids) or (None, )})
+        return
+    if len(ids) <= ARRAY_MAX_IDS:
+        yield (sql.SQL("{} = ANY({}::integer[])").format(
+                   column, sql.Placeholder(name)),
+               {name: '{%s}' % ','.join(str(id_) for id_ in ids)})
+        return
+    table = 'credit_control_ids_%d' % next(_table_sequence)
+    cr.execute(sql.SQL("CREATE TEMPORARY TABLE {} (id integer PRIMARY KEY)"
+                       " ON COMMIT DROP").format(sql.Identifier(table)))
+    cr.copy_from(io.StringIO('\n'.join(str(id_) for id_ in set(ids))),
+                 table, columns=('id', ))
+    cr.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+    yield (sql.SQL("{} IN (SELECT id FROM {})").format(
+               column, sql.Identifier(table)), {})
+    # on error, the table is dropped with the transaction, and a commit in
+    # the context has already dropped it
+    cr.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(
+        sql.Identifier(table)))
@@ -3,3 +3,4 @@ from . import test_credit_control_policy
 from . import test_res_partner
 from . import test_account_invoice
 from . import test_credit_control_run
+from . import test_credit_control_business_calendar
@@ -0,0 +1,137 @@
+# Copyright 2026 Okia SPRL (https://okia.be)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from psycopg2 import sql
+
+from odoo.exceptions import ValidationError
+from odoo.tests.common import TransactionCase
+from odoo.tests import tagged
+
+
+@tagged('post_install', '-at_install')
+class TestCreditControlBusinessCalendar(TransactionCase):
+
+    def setUp(self):
+        super(TestCreditControlBusinessCalendar, self).setUp()
+        # 2024-01-01 is a Monday
+        self.calendar = self.env['credit.control.business.calendar'].create({
+            'name': 'Test calendar',
+            'weekend_days': '6,7',
+            'date_from': '2024-01-01',
+            'date_to': '2024-01-31',
+            'holiday_ids': [(0, 0, {'name': 'Holiday',
+                                    'date': '2024-01-03'})],
+        })
+        self.level = self.env.ref('account_credit_control.3_time_2')
+        self.level.write({
+            'computation_mode': 'business_days',
+            'business_calendar_id': self.calendar.id,
+            'delay_days': 4,
+        })
+
+    def _get_ordinals(self):
+        days = self.env['credit.control.business.day'].search([
+            ('calendar_id', '=', self.calendar.id),
+            ('date', '<=', '2024-01-08'),
+        ])
+        return [day.ordinal for day in days]
+
+    def _boundary_reached(self, date_maturity, controlling_date,
+                          partner=None):
+        boundary = self.level._get_sql_date_boundary(controlling_date)
+        query = sql.SQL("SELECT 1 FROM (VALUES (%s::date, %s::integer))"
+                        " AS mv_line(date_maturity, partner_id)"
+                        " WHERE {}").format(
+                            sql.SQL(boundary.replace('%', '%%')))
+        self.env.cr.execute(query, (date_maturity,
+                                    partner.id if partner else None))
+        return bool(self.env.cr.fetchone())
+
+    def test_business_days(self):
+        """
+        The ordinals skip the weekends and the holidays of the calendar
+        """
+        self.assertEqual(self._get_ordinals(), [1, 2, 2, 3, 4, 4, 4, 5])
+        self.calendar.holiday_ids.unlink()
+        self.assertEqual(self._get_ordinals(), [1, 2, 3, 4, 5, 5, 5, 6])
+        self.calendar.weekend_days = '7'
+        self.assertEqual(self._get_ordinals(), [1, 2, 3, 4, 5, 6, 6, 7])
+
+    def test_business_days_holiday_range(self):
+        """
+        A holiday computes the ordinals again from its date only
+        """
+        cr = self.env.cr
+
+        def get_days():
+            cr.execute("SELECT date, ordinal, ctid::text"
+                       " FROM credit_control_business_day"
+                       " WHERE calendar_id = %s ORDER BY date",
+                       (self.calendar.id, ))
+            return cr.fetchall()
+        before = get_days()
+        holiday = self.env['credit.control.business.holiday'].create({
+            'name': 'Other holiday',
+            'date': '2024-01-10',
+            'calendar_id': self.calendar.id,
+        })
+        after = get_days()
+        self.assertEqual(len(after), len(before))
+        for (day, ordinal, ctid), (__, new_ordinal, new_ctid) in zip(
+                before, after):
+            if day < holiday.date:
+                self.assertEqual((new_ordinal, new_ctid), (ordinal, ctid))
+            else:
+                self.assertNotEqual(new_ctid, ctid)
+                self.assertEqual(new_ordinal, ordinal - 1)
+        # the same ordinals as computing the whole calendar
+        self.calendar._compute_business_days()
+        self.assertEqual([row[:2] for row in get_days()],
+                         [row[:2] for row in after])
+        holiday.date = '2024-01-15'
+        self.assertEqual(self._get_ordinals(), [1, 2, 2, 3, 4, 4, 4, 5])
+
+    def test_business_days_boundary(self):
+        """
+        The delay of a business days level is counted in business days
+        """
+        self.assertFalse(self._boundary_reached('2024-01-01', '2024-01-05'))
+        self.assertFalse(self._boundary_reached('2024-01-01', '2024-01-07'))
+        self.assertTrue(self._boundary_reached('2024-01-01', '2024-01-08'))
+        self.assertFalse(self._boundary_reached('2024-01-08', '2024-01-05'))
+        # outside of the calendar the days are counted in calendar days
+        self.assertTrue(self._boundary_reached('2023-12-01', '2024-01-08'))
+        self.assertFalse(self._boundary_reached('2024-01-30', '2024-02-02'))
+        self.assertTrue(self._boundary_reached('2024-01-30', '2024-02-03'))
+
+    def test_business_days_country(self):
+        """
+        The calendar of the country of the partner prevails over the one
+        of the level
+        """
+        country = self.env.ref('base.be')
+        partner = self.env['res.partner'].create({
+            'name': 'Partner',
+            'country_id': country.id,
+        })
+        self.assertTrue(self._boundary_reached('2024-01-01', '2024-01-08',
+                                               partner=partner))
+        # only the sundays are not worked in the country
+        self.env['credit.control.business.calendar'].create({
+            'name': 'Country calendar',
+            'weekend_days': '7',
+            'date_from': '2024-01-01',
+            'date_to': '2024-01-31',
+            'country_id': country.id,
+        })
+        self.assertFalse(self._boundary_reached('2024-01-01', '2024-01-04',
+                                                partner=partner))
+        self.assertTrue(self._boundary_reached('2024-01-01', '2024-01-05',
+                                               partner=partner))
+        self.assertFalse(self._boundary_reached('2024-01-01', '2024-01-05'))
+
+    def test_business_calendar_required(self):
+        """
+        A business days level needs a calendar
+        """
+        with self.assertRaises(ValidationError):
+            self.level.business_calendar_id = False
@@ -1,5 +1,8 @@
 # Copyright 2017 Okia SPRL (https://okia.be)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from psycopg2 import sql
+
+from odoo import fields
 from odoo.exceptions import ValidationError, UserError
 from odoo.tests.common import TransactionCase
 from odoo.tests import tagged
@@ -60,6 +63,44 @@ class TestCreditControlPolicy(TransactionCase):
         previous_level = level_2._previous_level()
         self.assertEqual(previous_level, level_1)
 
+    def test_level_chain(self):
+        """
+        The cached level chain follows the changes of the levels
+        """
+        policy = self.env.ref('account_credit_control.credit_control_3_time')
+        level_1 = self.env.ref('account_credit_control.3_time_1')
+        level_2 = self.env.ref('account_credit_control.3_time_2')
+        level_3 = self.env.ref('account_credit_control.3_time_3')
+        level_obj = self.env['credit.control.policy.level']
+
+        chain = level_obj._get_level_chain(policy.id)
+        self.assertEqual([row[0] for row in chain],
+                         [level_1.id, level_2.id, level_3.id])
+        self.assertEqual(chain[1][3:], (level_1.id, level_3.id))
+
+        level_4 = level_3.copy({'level': level_3.level + 1})
+        chain = level_obj._get_level_chain(policy.id)
+        self.assertEqual(chain[2][4], level_4.id)
+        self.assertEqual(level_4._previous_level(), level_3)
+
+        level_4.write({
+            'level': level_1.level - 1,
+            'computation_mode': 'net_days',
+        })
+        self.assertEqual(level_1._previous_level(), level_4)
+        self.assertIsNone(level_4._previous_level())
+
+        level_4.unlink()
+        self.assertIsNone(level_1._previous_level())
+
+        # the classification of the run follows the chain too
+        query = policy._get_level_classification_sql(
+            fields.Date.today(), sql.SQL('true')).as_string(self.env.cr)
+        for level, previous in ((level_1, 'NULL'),
+                                (level_2, level_1.level),
+                                (level_3, level_2.level)):
+            self.assertIn('(%s, %s::integer)' % (level.id, previous), query)
+
     def test_get_sql_date_boundary_for_computation_mode(self):
         """
         Check the where clauses statement return by the method
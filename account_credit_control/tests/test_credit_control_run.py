@@ -1,13 +1,87 @@
 # Copyright 2017 Okia SPRL (https://okia.be)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import asyncore
+import base64
+import io
+import os
 import re
-from datetime import datetime
+import shutil
+import smtpd
+import smtplib
+import socket
+import tempfile
+import threading
+import zipfile
+import zlib
+from concurrent.futures import Future
+from datetime import datetime, timedelta
 from dateutil import relativedelta
+from unittest import mock
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from psycopg2 import sql
 
 from odoo import fields
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import UserError
 from odoo.tests import tagged
+from ..models import computation_mode, credit_control_run, sql_ids
+from ..wizard import credit_control_printer
+
+
+class SMTPStandIn(smtpd.SMTPServer):
+    """ Local SMTP server keeping the messages it receives """
+
+    def __init__(self, *args, **kwargs):
+        super(SMTPStandIn, self).__init__(*args, **kwargs)
+        self.messages = []
+        self.connections = 0
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        super(SMTPStandIn, self).handle_accepted(conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+class SerialExecutor(object):
+    """ Worker pool running the submitted calls in the current thread """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+def fake_wkhtmltopdf(bodies, **kwargs):
+    """ PDF with a blank page per body, its width identifying the body,
+    and an outline entry per body like the heading of a letter
+    """
+    writer = PdfFileWriter()
+    for body in bodies:
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        writer.addBlankPage(width=100 + zlib.crc32(body) % 500, height=100)
+        writer.addBookmark('Letter', writer.getNumPages() - 1)
+    stream = io.BytesIO()
+    writer.write(stream)
+    return stream.getvalue()
+
+
+def pdf_page_widths(pdf):
+    reader = PdfFileReader(io.BytesIO(pdf))
+    return [float(reader.getPage(index).mediaBox.getWidth())
+            for index in range(reader.getNumPages())]
 
 
 @tagged('post_install', '-at_install')
@@ -116,6 +190,1080 @@ class TestCreditControlRun(TransactionCase):
         regex_result = re.match(report_regex, control_run.report)
         self.assertIsNotNone(regex_result)
 
+    def test_generate_credit_lines_ignore_previous_drafts(self):
+        """
+        Lines left in draft by a previous run on the same level are
+        ignored when the lines are generated again
+        """
+        first_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        first_run.generate_credit_lines()
+        first_lines = first_run.line_ids
+        self.assertEqual(len(first_lines), 1)
+        self.assertEqual(first_lines.state, 'draft')
+
+        second_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        second_run.generate_credit_lines()
+        second_lines = second_run.line_ids
+        self.assertEqual(len(second_lines), 1)
+        self.assertEqual(second_lines.state, 'draft')
+        self.assertEqual(second_lines.policy_level_id,
+                         first_lines.policy_level_id)
+        self.assertEqual(first_lines.state, 'ignored')
+        self.assertEqual(len(self.invoice.credit_control_line_ids), 2)
+
+    def test_get_level_move_lines(self):
+        """
+        The single query classification of a policy gives the same move
+        lines as the classification done level per level
+        """
+        six_months = datetime.today() - relativedelta.relativedelta(months=6)
+        first_control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.to_string(six_months),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        first_control_run.generate_credit_lines()
+        first_control_run.line_ids.write({'state': 'sent'})
+
+        today = fields.Date.today()
+        lines = self.policy._get_move_lines_to_process(today)
+        level_lines = self.policy._get_level_move_lines(today, lines)
+        self.assertEqual(set(level_lines), set(self.policy.level_ids))
+        for level in self.policy.level_ids:
+            self.assertEqual(level_lines[level],
+                             level.get_level_lines(today, lines))
+        level_2 = self.env.ref('account_credit_control.3_time_2')
+        self.assertEqual(level_lines[level_2],
+                         self.invoice.move_id.line_ids.filtered(
+                             lambda line: line.debit and line in lines))
+
+    def test_python_computation_mode(self):
+        """
+        A computation mode evaluated in Python classifies the move lines
+        like its SQL equivalent
+        """
+        def net_days(level, controlling_date, maturity_dates,
+                     previous_dates):
+            delay = timedelta(days=level.delay_days)
+            return [bool(date_maturity) and
+                    date_maturity + delay <= controlling_date
+                    for date_maturity in maturity_dates]
+
+        today = fields.Date.today()
+        level_1 = self.env.ref('account_credit_control.3_time_1')
+        lines = self.policy._get_move_lines_to_process(today)
+        expected = self.policy._get_level_move_lines(today, lines)
+        self.assertTrue(expected[level_1])
+
+        computation_mode.register_computation_mode(
+            'python_net_days', 'Due Date (Python)', evaluator=net_days)
+        try:
+            level_obj = self.env['credit.control.policy.level']
+            selection = level_obj._fields['computation_mode'].selection
+            self.assertIn(('python_net_days', 'Due Date (Python)'),
+                          selection(level_obj))
+            level_1.computation_mode = 'python_net_days'
+            self.assertIsNone(
+                level_1._get_sql_date_boundary_for_computation_mode())
+            self.assertEqual(
+                self.policy._get_level_move_lines(today, lines), expected)
+            self.assertEqual(level_1.get_level_lines(today, lines),
+                             expected[level_1])
+        finally:
+            del computation_mode.COMPUTATION_MODES['python_net_days']
+
+    def test_move_line_current_credit_level(self):
+        """
+        The current credit control level of the move lines follows the
+        changes of their credit control lines
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.generate_credit_lines()
+        control_line = control_run.line_ids
+        move_line = control_line.move_line_id
+        self.assertEqual(move_line.credit_control_line_id, control_line)
+        self.assertEqual(move_line.credit_control_level, 1)
+        self.assertEqual(move_line.credit_control_state, 'draft')
+        self.assertFalse(move_line.credit_control_reminded)
+
+        control_line.write({'state': 'sent'})
+        self.assertEqual(move_line.credit_control_state, 'sent')
+        self.assertTrue(move_line.credit_control_reminded)
+
+        control_line.write({'manually_overridden': True})
+        self.assertFalse(move_line.credit_control_line_id)
+        self.assertFalse(move_line.credit_control_level)
+        self.assertFalse(move_line.credit_control_reminded)
+
+    def test_move_line_credit_policy(self):
+        """
+        The policy of the move lines is the one of the invoice, otherwise
+        the one of the partner, and it drives the lines to process
+        """
+        move_line = self.invoice.move_id.line_ids.filtered(
+            lambda line: line.account_id == self.invoice.account_id)
+        self.assertEqual(move_line.credit_policy_id, self.policy)
+        today = fields.Date.today()
+        self.assertIn(move_line,
+                      self.policy._get_move_lines_to_process(today))
+
+        policy_2 = self.env.ref('account_credit_control.credit_control_2_time')
+        policy_2.account_ids = self.policy.account_ids
+        self.invoice.credit_policy_id = policy_2
+        self.assertEqual(move_line.credit_policy_id, policy_2)
+        self.assertNotIn(move_line,
+                         self.policy._get_move_lines_to_process(today))
+        self.assertIn(move_line, policy_2._get_move_lines_to_process(today))
+
+        # the policy of the company applies without invoice and partner
+        # policies
+        self.invoice.credit_policy_id = False
+        self.invoice.partner_id.credit_policy_id = False
+        self.invoice.company_id.credit_policy_id = policy_2
+        self.assertEqual(move_line.credit_policy_id, policy_2)
+        self.invoice.company_id.credit_policy_id = self.policy
+        self.assertEqual(move_line.credit_policy_id, self.policy)
+
+        # the low-level writes, used by the imports, update the move lines
+        self.invoice.company_id._write({'credit_policy_id': policy_2.id})
+        self.assertEqual(move_line.credit_policy_id, policy_2)
+
+        # the existing move lines are filled after the installation
+        self.env.cr.execute(
+            "UPDATE account_move_line SET credit_policy_id = NULL"
+            " WHERE id = %s", (move_line.id, ))
+        move_line.invalidate_cache(['credit_policy_id'])
+        self.env['account.move.line']._fill_credit_policy()
+        self.assertEqual(move_line.credit_policy_id, policy_2)
+
+    def test_partner_shards(self):
+        """
+        The move lines of a partner always belong to the same shard, the
+        shards being balanced on their number of lines
+        """
+        partner = self.invoice.partner_id
+        # two lines for the partner, one line for two other partners
+        for invoice_partner in (partner, partner.copy(), partner.copy()):
+            invoice = self.invoice.copy({
+                'partner_id': invoice_partner.id,
+                'date_invoice': self.invoice.date_invoice,
+                'date_due': self.invoice.date_due,
+            })
+            invoice.action_invoice_open()
+        lines = self.policy._get_move_lines_to_process(fields.Date.today())
+        self.assertEqual(len(lines), 4)
+        run_obj = self.env['credit.control.run']
+        shards = run_obj._get_partner_shards(lines, 2)
+        self.assertEqual(sorted(sum(shards, [])), sorted(lines.ids))
+        self.assertEqual([len(line_ids) for line_ids in shards], [2, 2])
+        self.assertEqual(lines.browse(shards[0]).mapped('partner_id'),
+                         partner)
+
+    def _advisory_locks(self, cr):
+        """ Number of advisory locks held by the connection of a cursor """
+        cr.execute("SELECT count(*) FROM pg_locks"
+                   " WHERE locktype = 'advisory'"
+                   " AND pid = pg_backend_pid()")
+        return cr.fetchone()[0]
+
+    def test_generate_credit_lines_parallel(self):
+        """
+        Generate the lines in shards committed by several workers, the
+        lines being linked to the run and the policy staying locked
+        across the commits
+        """
+        invoice_2 = self.invoice.copy({
+            'partner_id': self.invoice.partner_id.copy().id,
+            'date_invoice': self.invoice.date_invoice,
+            'date_due': self.invoice.date_due,
+        })
+        invoice_2.action_invoice_open()
+        self.env.user.company_id.credit_control_run_workers = 2
+        # the run and the workers work on test cursors, whose commits are
+        # savepoints in the transaction of the test
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        run_model = self.env.registry['credit.control.run']
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        locks = []
+
+        def generate_shard_lines(run, policy_id, line_ids):
+            locks.append(self._advisory_locks(run.env.cr))
+            return generate_shard_lines.original(run, policy_id, line_ids)
+        generate_shard_lines.original = run_model._generate_shard_lines
+
+        with mock.patch.object(credit_control_run, 'ThreadPoolExecutor',
+                               SerialExecutor), \
+                mock.patch.object(run_model, '_commit_checkpoint',
+                                  autospec=True,
+                                  side_effect=run_model._commit_checkpoint
+                                  ) as commit, \
+                mock.patch.object(run_model, '_generate_shard_lines',
+                                  autospec=True,
+                                  side_effect=generate_shard_lines), \
+                self.registry.cursor() as cr:
+            control_run.with_env(control_run.env(cr=cr)).\
+                generate_credit_lines()
+            self.assertEqual(self._advisory_locks(cr), 0)
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(locks, [1, 1])
+        control_run.invalidate_cache()
+        self.assertEqual(control_run.state, 'done')
+        invoices = self.invoice | invoice_2
+        self.assertEqual(len(invoices.mapped('credit_control_line_ids')), 2)
+        self.assertEqual(control_run.line_ids,
+                         invoices.mapped('credit_control_line_ids'))
+        self.assertEqual(
+            set(control_run.stat_ids.mapped('phase')),
+            {'move_lines', 'different_policy', 'classification',
+             'creation'})
+
+    def test_generate_credit_lines_chunked(self):
+        """
+        Generate the lines per batch of partners, resuming after the
+        checkpoint of an interrupted run
+        """
+        self.env.user.company_id.credit_control_run_batch_size = 1
+        # the commits of the run are savepoints of the test cursors
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        run_model = self.env.registry['credit.control.run']
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        # an interrupted run already committed the batch of the partner
+        control_run.write({
+            'checkpoint_policy_id': self.policy.id,
+            'checkpoint_partner_id': self.invoice.partner_id.id,
+        })
+        with mock.patch.object(run_model, '_commit_checkpoint',
+                               autospec=True,
+                               side_effect=run_model._commit_checkpoint
+                               ) as commit, \
+                self.registry.cursor() as cr:
+            control_run.with_env(control_run.env(cr=cr)).\
+                generate_credit_lines()
+        commit.assert_not_called()
+        control_run.invalidate_cache()
+        self.assertFalse(control_run.line_ids)
+        self.assertFalse(control_run.checkpoint_policy_id)
+
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        with mock.patch.object(run_model, '_commit_checkpoint',
+                               autospec=True,
+                               side_effect=run_model._commit_checkpoint
+                               ) as commit, \
+                self.registry.cursor() as cr:
+            control_run.with_env(control_run.env(cr=cr)).\
+                generate_credit_lines()
+            self.assertEqual(self._advisory_locks(cr), 0)
+        self.assertEqual(commit.call_count, 1)
+        control_run.invalidate_cache()
+        self.assertEqual(control_run.state, 'done')
+        self.assertEqual(control_run.line_ids,
+                         self.invoice.credit_control_line_ids)
+        self.assertFalse(control_run.checkpoint_partner_id)
+
+    def test_filter_changed_move_lines(self):
+        """
+        An incremental run only keeps the move lines written since the
+        previous run or whose date boundary has been crossed since then
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+            'incremental': True,
+        })
+        lines = self.policy._get_move_lines_to_process(control_run.date)
+        self.assertTrue(lines)
+        past = datetime.today() - relativedelta.relativedelta(years=2)
+        future = datetime.today() + relativedelta.relativedelta(days=1)
+        yesterday = datetime.today() - relativedelta.relativedelta(days=1)
+
+        changed = control_run._filter_changed_move_lines(
+            self.policy, lines, fields.Date.to_string(yesterday), past)
+        self.assertEqual(changed, lines)
+        # nothing written nor crossed since yesterday
+        changed = control_run._filter_changed_move_lines(
+            self.policy, lines, fields.Date.to_string(yesterday), future)
+        self.assertFalse(changed)
+        # the first level has been reached since two years
+        changed = control_run._filter_changed_move_lines(
+            self.policy, lines, fields.Date.to_string(past), future)
+        self.assertEqual(changed, lines)
+
+    def test_incremental_run(self):
+        """
+        An incremental run only processes the move lines which may have
+        changed since the previous run, unless the configuration of the
+        policy has changed since then
+        """
+        run_obj = self.env['credit.control.run']
+        today = fields.Date.today()
+        first_run = run_obj.create({
+            'date': today,
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        first_run.generate_credit_lines()
+        self.assertTrue(first_run.line_ids)
+        first_run.set_to_ready_lines()
+        # the records of the test are older than the first run
+        watermark = datetime.now() + timedelta(hours=1)
+        first_run.watermark = watermark
+
+        second_run = run_obj.create({
+            'date': today,
+            'policy_ids': [(6, 0, [self.policy.id])],
+            'incremental': True,
+        })
+        second_run.generate_credit_lines()
+        self.assertEqual(second_run.state, 'done')
+        self.assertFalse(second_run.line_ids)
+        stat = second_run.stat_ids.filtered(
+            lambda s: s.phase == 'incremental')
+        self.assertEqual(stat.row_count, 0)
+
+        lines = self.policy._get_move_lines_to_process(today)
+        self.assertFalse(
+            run_obj._is_policy_changed(self.policy, lines, watermark))
+        # only the calendars of the countries of the partners matter
+        level = self.policy.level_ids[:1]
+        calendar_obj = self.env['credit.control.business.calendar']
+        calendar_vals = {
+            'weekend_days': '6,7',
+            'date_from': today,
+            'date_to': today,
+        }
+        level.business_calendar_id = calendar_obj.create(
+            dict(calendar_vals, name='Level calendar'))
+        country_calendar = calendar_obj.create(
+            dict(calendar_vals, name='Country calendar',
+                 country_id=self.env.ref('base.be').id))
+        self.env.cr.execute(
+            "UPDATE credit_control_business_calendar SET write_date = %s"
+            " WHERE id = %s",
+            (watermark + timedelta(hours=1), country_calendar.id))
+        country_calendar.invalidate_cache(['write_date'],
+                                          country_calendar.ids)
+        self.assertFalse(
+            run_obj._is_policy_changed(self.policy, lines, watermark))
+        self.invoice.partner_id.country_id = self.env.ref('base.be')
+        self.assertTrue(
+            run_obj._is_policy_changed(self.policy, lines, watermark))
+        self.invoice.partner_id.country_id = False
+        # the tolerance of the company applies to all the lines
+        company = self.env.user.company_id
+        self.env.cr.execute(
+            "UPDATE res_company SET write_date = %s WHERE id = %s",
+            (watermark + timedelta(hours=1), company.id))
+        company.invalidate_cache(['write_date'], company.ids)
+        self.assertTrue(
+            run_obj._is_policy_changed(self.policy, lines, watermark))
+        self.env.cr.execute(
+            "UPDATE res_company SET write_date = %s WHERE id = %s",
+            (watermark - timedelta(hours=2), company.id))
+        company.invalidate_cache(['write_date'], company.ids)
+
+        # a level written after the first run may move any line
+        self.env.cr.execute(
+            "UPDATE credit_control_policy_level SET write_date = %s"
+            " WHERE id = %s", (watermark + timedelta(hours=1), level.id))
+        level.invalidate_cache(['write_date'], level.ids)
+        self.assertTrue(
+            run_obj._is_policy_changed(self.policy, lines, watermark))
+        third_run = run_obj.create({
+            'date': today,
+            'policy_ids': [(6, 0, [self.policy.id])],
+            'incremental': True,
+        })
+        third_run.generate_credit_lines()
+        self.assertEqual(third_run.state, 'done')
+        self.assertFalse(third_run.stat_ids.filtered(
+            lambda s: s.phase == 'incremental'))
+
+    def test_preview(self):
+        """
+        The preview of a run announces the lines it generates
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        preview_data = self.policy._get_preview_data(control_run.date)
+        self.assertEqual([data['level'] for data in preview_data],
+                         list(self.policy.level_ids))
+        control_run.action_preview()
+        self.assertTrue(control_run.preview)
+        self.assertFalse(self.invoice.credit_control_line_ids)
+
+        control_run.generate_credit_lines()
+        for data in preview_data:
+            level_lines = control_run.line_ids.filtered(
+                lambda line: line.policy_level_id == data['level'])
+            self.assertEqual(data['lines'], len(level_lines))
+            self.assertEqual(data['partners'],
+                             len(level_lines.mapped('partner_id')))
+            self.assertAlmostEqual(
+                data['amount'], sum(level_lines.mapped('balance_due')))
+
+    def test_lock_run(self):
+        """
+        A run locks its policies for its company only, until they are
+        unlocked
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        keys = control_run._lock_run()
+        company = control_run.company_id
+        other_company = self.env['res.company'].create({'name': 'Other'})
+        run_obj = self.env['credit.control.run']
+        try:
+            with self.registry.cursor() as cr:
+                cr.execute('SELECT pg_try_advisory_xact_lock(%s)',
+                           (run_obj._get_lock_key(company, self.policy), ))
+                self.assertFalse(cr.fetchone()[0])
+                cr.execute('SELECT pg_try_advisory_xact_lock(%s)',
+                           (run_obj._get_lock_key(other_company,
+                                                  self.policy), ))
+                self.assertTrue(cr.fetchone()[0])
+        finally:
+            # the session locks survive the rollback of the test
+            run_obj._unlock_run(keys)
+        with self.registry.cursor() as cr:
+            cr.execute('SELECT pg_try_advisory_xact_lock(%s)',
+                       (run_obj._get_lock_key(company, self.policy), ))
+            self.assertTrue(cr.fetchone()[0])
+
+    def test_run_stats(self):
+        """
+        A run records the statistics of its phases per policy and level
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.with_context(lang='en_US').generate_credit_lines()
+        stats = control_run.stat_ids
+        self.assertEqual(
+            set(stats.mapped('phase')),
+            {'move_lines', 'different_policy', 'classification',
+             'creation'})
+        move_lines_stat = stats.filtered(lambda s: s.phase == 'move_lines')
+        self.assertEqual(move_lines_stat.policy_id, self.policy)
+        self.assertEqual(move_lines_stat.row_count, 1)
+        creation_stats = stats.filtered(lambda s: s.phase == 'creation')
+        self.assertEqual(creation_stats.mapped('level_id'),
+                         self.policy.level_ids)
+        self.assertEqual(sum(creation_stats.mapped('row_count')),
+                         len(control_run.line_ids))
+
+    def test_generate_comm_from_credit_lines(self):
+        """
+        Communications group the credit lines per partner, level and
+        currency
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.with_context(lang='en_US').generate_credit_lines()
+        lines = control_run.line_ids
+        self.assertTrue(lines)
+        comm_obj = self.env['credit.control.communication']
+        comms = comm_obj._generate_comm_from_credit_lines(lines)
+        self.assertEqual(comms.mapped('credit_control_line_ids'), lines)
+        for comm in comms:
+            for line in comm.credit_control_line_ids:
+                self.assertEqual(line.partner_id, comm.partner_id)
+                self.assertEqual(line.policy_level_id,
+                                 comm.current_policy_level)
+
+    def test_printer_report_chunks(self):
+        """
+        The letters are split in ordered chunks for the report workers
+        """
+        partner = self.env['res.partner'].create({'name': 'Letters'})
+        comms = self.env['credit.control.communication'].create([{
+            'partner_id': partner.id,
+            'current_policy_level': self.policy.level_ids[0].id,
+            'currency_id': self.env.user.company_id.currency_id.id,
+        } for __ in range(10)])
+        printer_obj = self.env['credit.control.printer']
+        chunks = printer_obj._get_report_chunks(comms, 2)
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(
+            [comm for chunk in chunks for comm in chunk], list(comms))
+        self.assertEqual(len(printer_obj._get_report_chunks(comms, 4)), 10)
+
+    def _create_letter_comms(self, count):
+        return self.env['credit.control.communication'].create([{
+            'partner_id': self.env['res.partner'].create({
+                'name': 'Letters %d' % index,
+            }).id,
+            'current_policy_level': self.policy.level_ids[0].id,
+            'currency_id': self.env.user.company_id.currency_id.id,
+        } for index in range(count)])
+
+    def test_printer_render_chunks(self):
+        """
+        The letters rendered per chunk by the report workers give the
+        pages of the document rendered at once
+        """
+        comms = self._create_letter_comms(5)
+        self.env.user.company_id.credit_control_report_workers = 2
+        report = self.env['ir.actions.report']._get_report_from_name(
+            'account_credit_control.report_credit_control_summary')
+        report_model = self.env.registry['ir.actions.report']
+        printer_obj = self.env['credit.control.printer']
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with mock.patch.object(report_model, '_run_wkhtmltopdf',
+                               side_effect=fake_wkhtmltopdf) as wkhtmltopdf, \
+                mock.patch.object(credit_control_printer,
+                                  'ThreadPoolExecutor', SerialExecutor):
+            bodies = report._prepare_html(
+                report.render_qweb_html(comms.ids)[0])[0]
+            serial = report._run_wkhtmltopdf(bodies)
+            chunks = printer_obj._render_pdf_chunks(report, comms, directory)
+        # the serial conversion and one per chunk of letters
+        self.assertEqual(wkhtmltopdf.call_count, 6)
+        self.assertEqual(len(pdf_page_widths(serial)), 5)
+        self.assertEqual([comm for chunk, __ in chunks for comm in chunk],
+                         list(comms))
+        widths = []
+        for __, path in chunks:
+            with open(path, 'rb') as pdf_file:
+                widths += pdf_page_widths(pdf_file.read())
+        self.assertEqual(widths, pdf_page_widths(serial))
+
+    def test_printer_report_action(self):
+        """
+        The report output of the printer is the action of the report,
+        whatever the number of report workers
+        """
+        self.env.user.company_id.credit_control_report_workers = 2
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.with_context(lang='en_US').generate_credit_lines()
+        printer = self.env['credit.control.printer'].create({
+            'line_ids': [(6, 0, control_run.line_ids.ids)],
+            'mark_as_sent': False,
+        })
+        action = printer.print_lines()
+        self.assertEqual(action['type'], 'ir.actions.report')
+        self.assertEqual(
+            action['report_name'],
+            'account_credit_control.report_credit_control_summary')
+
+    def test_printer_export_pdf(self):
+        """
+        The PDF of every chunk of letters is appended to the exported file
+        """
+        comms = self._create_letter_comms(5)
+        report = self.env['ir.actions.report']._get_report_from_name(
+            'account_credit_control.report_credit_control_summary')
+        report = report.with_context(force_report_rendering=True)
+        report_model = self.env.registry['ir.actions.report']
+        printer_model = self.env.registry['credit.control.printer']
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with mock.patch.object(report_model, '_run_wkhtmltopdf',
+                               side_effect=fake_wkhtmltopdf), \
+                mock.patch.object(printer_model, '_get_export_chunk_size',
+                                  return_value=2):
+            bodies = report._prepare_html(
+                report.render_qweb_html(comms.ids)[0])[0]
+            serial = report._run_wkhtmltopdf(bodies)
+            self.env['credit.control.printer']._export_letters_pdf(
+                report, comms, path)
+        with open(path, 'rb') as pdf_file:
+            exported = pdf_file.read()
+        self.assertEqual(pdf_page_widths(exported), pdf_page_widths(serial))
+
+    def test_printer_export_zip(self):
+        """
+        The printer exports the letters of every partner in a ZIP file
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.with_context(lang='en_US').generate_credit_lines()
+        printer = self.env['credit.control.printer'].create({
+            'line_ids': [(6, 0, control_run.line_ids.ids)],
+            'mark_as_sent': False,
+            'output': 'zip',
+        })
+        report_model = self.env.registry['ir.actions.report']
+        with mock.patch.object(report_model, '_run_wkhtmltopdf',
+                               side_effect=fake_wkhtmltopdf):
+            action = printer.print_lines()
+        self.assertEqual(action['type'], 'ir.actions.act_url')
+        self.assertIn(printer.export_token, action['url'])
+        path = printer.export_path
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual(
+                len(archive.namelist()),
+                len(control_run.line_ids.mapped('partner_id')))
+        printer.unlink()
+        self.assertFalse(os.path.exists(path))
+
+    def test_printer_export_zip_chunks(self):
+        """
+        The letters of a partner split over several chunks end up in a
+        single file of the ZIP, also when a chunk is rendered again letter
+        per letter
+        """
+        comms = self._create_letter_comms(3)
+        comms |= comms[0].copy() | comms[0].copy()
+        report = self.env['ir.actions.report']._get_report_from_name(
+            'account_credit_control.report_credit_control_summary')
+        report_model = self.env.registry['ir.actions.report']
+        printer_model = self.env.registry['credit.control.printer']
+        printer_obj = self.env['credit.control.printer']
+        widths = {}
+        for comm in comms:
+            bodies = report._prepare_html(
+                report.render_qweb_html(comm.ids)[0])[0]
+            widths.setdefault(comm.partner_id.id, []).extend(
+                pdf_page_widths(fake_wkhtmltopdf(bodies)))
+        for outline_match in (True, False):
+            fd, path = tempfile.mkstemp(suffix='.zip')
+            os.close(fd)
+            self.addCleanup(os.remove, path)
+            get_letters_pages = printer_model._get_letters_pages
+            with mock.patch.object(report_model, '_run_wkhtmltopdf',
+                                   side_effect=fake_wkhtmltopdf), \
+                    mock.patch.object(printer_model,
+                                      '_get_export_chunk_size',
+                                      return_value=2), \
+                    mock.patch.object(
+                        printer_model, '_get_letters_pages', autospec=True,
+                        side_effect=lambda printer, reader, nb_letters: (
+                            get_letters_pages(printer, reader, nb_letters)
+                            if outline_match or nb_letters == 1
+                            else None)):
+                printer_obj._export_letters_zip(report, comms, path)
+            with zipfile.ZipFile(path) as archive:
+                names = archive.namelist()
+                self.assertEqual(len(names), 3)
+                for name in names:
+                    partner_id = int(name.split(' - ')[0])
+                    self.assertEqual(
+                        sorted(pdf_page_widths(archive.read(name))),
+                        sorted(widths[partner_id]))
+
+    def _queue_credit_emails(self):
+        self.env.user.company_id.email = 'credit@example.com'
+        self.invoice.partner_id.email = 'partner@example.com'
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.with_context(lang='en_US').generate_credit_lines()
+        lines = self.invoice.credit_control_line_ids
+        self.env['credit.control.marker'].create({
+            'name': 'to_be_sent',
+            'line_ids': [(6, 0, lines.ids)],
+        }).mark_lines()
+        self.env['credit.control.emailer'].create({
+            'line_ids': [(6, 0, lines.ids)],
+        }).email_lines()
+        return lines
+
+    def _create_mail_server(self, port):
+        return self.env['ir.mail_server'].create({
+            'name': 'SMTP stand-in',
+            'smtp_host': '127.0.0.1',
+            'smtp_port': port,
+            'smtp_encryption': 'none',
+        })
+
+    def test_email_queue(self):
+        """
+        The credit lines are sent once the dispatch queue delivered their
+        email
+        """
+        lines = self._queue_credit_emails()
+        self.assertEqual(set(lines.mapped('state')), {'queued'})
+        mails = lines.mapped('mail_message_id')
+        self.assertTrue(all(mails.mapped('credit_control_queued')))
+        # the generic queue leaves them to the dispatcher
+        self.env['mail.mail'].process_email_queue()
+        self.assertEqual(set(mails.mapped('state')), {'outgoing'})
+
+        server_map = {}
+        smtp = SMTPStandIn(('127.0.0.1', 0), None, map=server_map,
+                           decode_data=False)
+        thread = threading.Thread(target=asyncore.loop,
+                                  kwargs={'timeout': 0.1, 'map': server_map})
+        thread.start()
+        try:
+            mail_server = self._create_mail_server(
+                smtp.socket.getsockname()[1])
+            mails.write({'mail_server_id': mail_server.id})
+            nb_mails = len(mails)
+            # emails are not sent in test mode
+            with mock.patch.object(threading.current_thread(), 'testing',
+                                   False, create=True):
+                self.env['mail.mail'].process_credit_control_queue()
+                # the next execution reuses the connection of the pool
+                mail = self.env['mail.mail'].create({
+                    'subject': 'Reminder',
+                    'email_to': 'partner@example.com',
+                    'mail_server_id': mail_server.id,
+                    'credit_control_queued': True,
+                })
+                self.env['mail.mail'].process_credit_control_queue()
+        finally:
+            smtp.close()
+            thread.join()
+        self.assertEqual(len(smtp.messages), nb_mails + 1)
+        self.assertEqual(smtp.messages[0][1], ['partner@example.com'])
+        self.assertEqual(smtp.connections, 1)
+        self.assertEqual(mail.state, 'sent')
+        self.assertEqual(set(lines.mapped('state')), {'sent'})
+
+    def test_email_queue_retry(self):
+        """
+        An email which could not be delivered is tried again later
+        """
+        lines = self._queue_credit_emails()
+        mails = lines.mapped('mail_message_id')
+        # nothing listens on the port of a closed socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        mails.write({'mail_server_id': self._create_mail_server(port).id})
+        mail_obj = self.env['mail.mail']
+        with mock.patch.object(threading.current_thread(), 'testing',
+                               False, create=True):
+            mail_obj.process_credit_control_queue()
+            self.assertEqual(set(mails.mapped('state')), {'outgoing'})
+            self.assertEqual(mails.mapped('credit_control_retry_count'),
+                             [1] * len(mails))
+            self.assertEqual(set(lines.mapped('state')), {'queued'})
+            # the next attempt waits for its delay
+            mail_obj.process_credit_control_queue()
+            self.assertEqual(mails.mapped('credit_control_retry_count'),
+                             [1] * len(mails))
+            mail_obj.env['ir.config_parameter'].set_param(
+                'account_credit_control.email_queue_max_retries', 2)
+            mails.write({'credit_control_next_try': False})
+            mail_obj.process_credit_control_queue()
+        self.assertEqual(set(mails.mapped('state')), {'exception'})
+        self.assertEqual(set(lines.mapped('state')), {'email_error'})
+
+    def test_email_queue_refused(self):
+        """
+        An email whose recipients are refused stays in the credit control
+        queue, out of the reach of the generic queue
+        """
+        lines = self._queue_credit_emails()
+        mails = lines.mapped('mail_message_id')
+        mails._postprocess_sent_message(success_pids=[],
+                                        failure_type='RECIPIENT')
+        self.assertEqual(set(mails.mapped('state')), {'exception'})
+        self.assertTrue(all(mails.mapped('credit_control_queued')))
+        self.assertEqual(set(lines.mapped('state')), {'email_error'})
+        # a manual retry goes through the credit control queue
+        mails.mark_outgoing()
+        self.env['mail.mail'].process_email_queue()
+        self.assertEqual(set(mails.mapped('state')), {'outgoing'})
+
+    def test_email_queue_domain_limit(self):
+        """
+        The emails per recipient domain are limited over a time window,
+        across the executions of the queue
+        """
+        mail_obj = self.env['mail.mail']
+        mails = mail_obj.create([{
+            'subject': 'Reminder',
+            'email_to': 'customer%d@example.com' % index,
+            'credit_control_queued': True,
+        } for index in range(3)])
+        other = mail_obj.create({
+            'subject': 'Reminder',
+            'email_to': 'customer@example.org',
+            'credit_control_queued': True,
+        })
+        self.env['ir.config_parameter'].set_param(
+            'account_credit_control.email_queue_domain_limits',
+            'example.com:2')
+        params = mail_obj._get_credit_control_queue_params()
+        self.assertEqual((mails | other)._filter_domain_limits(params),
+                         mails[:2] | other)
+        # the next execution in the same window sends nothing more
+        self.assertEqual(mails[2:]._filter_domain_limits(params),
+                         mail_obj)
+        counter = self.env['credit.control.mail.domain'].search([
+            ('name', '=', 'example.com'),
+        ])
+        self.assertEqual(counter.sent_count, 2)
+        counter.window_start = fields.Datetime.now() - timedelta(
+            minutes=params['domain_window'])
+        self.assertEqual(mails[2:]._filter_domain_limits(params),
+                         mails[2:])
+        self.assertEqual(counter.sent_count, 1)
+
+    def test_email_queue_disconnected(self):
+        """
+        The emails left unsent when the mail server closes the connection
+        count an attempt, up to the maximum number of attempts
+        """
+        lines = self._queue_credit_emails()
+        mails = lines.mapped('mail_message_id')
+        self.env['ir.config_parameter'].set_param(
+            'account_credit_control.email_queue_max_retries', 2)
+        server_model = self.env.registry['ir.mail_server']
+        mail_model = self.env.registry['mail.mail']
+        mail_obj = self.env['mail.mail']
+        with mock.patch.object(server_model, 'connect'), \
+                mock.patch.object(
+                    mail_model, '_send',
+                    side_effect=smtplib.SMTPServerDisconnected('closed')):
+            mail_obj.process_credit_control_queue()
+            self.assertEqual(set(mails.mapped('state')), {'outgoing'})
+            self.assertEqual(mails.mapped('credit_control_retry_count'),
+                             [1] * len(mails))
+            self.assertTrue(all(mails.mapped('credit_control_next_try')))
+            self.assertEqual(set(lines.mapped('state')), {'queued'})
+            mails.write({'credit_control_next_try': False})
+            mail_obj.process_credit_control_queue()
+        self.assertEqual(set(mails.mapped('state')), {'exception'})
+        self.assertEqual(set(mails.mapped('failure_reason')), {'closed'})
+        self.assertEqual(set(lines.mapped('state')), {'email_error'})
+
+    def test_email_attachments(self):
+        """
+        Every email has its own attachments, identical contents share
+        their file in the filestore
+        """
+        comms = self._create_letter_comms(2)
+        template_cls = type(self.env['mail.template'])
+
+        def generate_email(template, res_ids, fields=None):
+            return {res_id: {
+                'subject': 'Reminder',
+                'body_html': '<p>Reminder</p>',
+                'attachments': [
+                    ('summary.pdf', base64.b64encode(b'summary')),
+                ],
+            } for res_id in res_ids}
+        with mock.patch.object(template_cls, 'generate_email',
+                               autospec=True, side_effect=generate_email):
+            emails = comms._generate_emails()
+        self.assertEqual(len(emails), 2)
+        attachments = emails.mapped('attachment_ids')
+        self.assertEqual(len(attachments), 2)
+        for email in emails:
+            self.assertEqual(email.attachment_ids.res_model, 'mail.mail')
+            self.assertEqual(email.attachment_ids.res_id, email.id)
+        self.assertEqual(len(set(attachments.mapped('store_fname'))), 1)
+
+    def test_ids_condition(self):
+        """
+        The id sets give the same rows whatever the strategy used
+        """
+        cr = self.env.cr
+        partners = self.env['res.partner'].search([], limit=5)
+        ids = partners.ids + [-1]
+        for in_max, array_max in ((10, 10), (1, 10), (1, 1)):
+            with mock.patch.object(sql_ids, 'IN_MAX_IDS', in_max), \
+                    mock.patch.object(sql_ids, 'ARRAY_MAX_IDS', array_max):
+                with sql_ids.ids_condition(cr, 'partner.id', ids,
+                                           'partner_ids') as (condition,
+                                                              params):
+                    cr.execute(sql.SQL("SELECT partner.id"
+                                       " FROM res_partner partner"
+                                       " WHERE {}").format(
+                                           condition), params)
+                    found = {row[0] for row in cr.fetchall()}
+            self.assertEqual(found, set(partners.ids))
+        # a commit in the context drops the temporary table before it
+        with mock.patch.object(sql_ids, 'IN_MAX_IDS', 1), \
+                mock.patch.object(sql_ids, 'ARRAY_MAX_IDS', 1):
+            with sql_ids.ids_condition(cr, 'id', ids) as (condition,
+                                                          params):
+                cr.execute("DISCARD TEMP")
+
+    def test_partial_indexes(self):
+        """
+        The queries on the credit lines are planned with their indexes
+        """
+        cr = self.env.cr
+        # the test tables are too small for the planner to prefer an index
+        cr.execute("SET LOCAL enable_seqscan = off")
+        queries = {
+            'credit_control_line_move_line_policy_index': (
+                "SELECT move_line_id FROM credit_control_line"
+                " WHERE policy_id != %(id)s"
+                " AND move_line_id IN %(ids)s"
+                " AND manually_overridden IS false"),
+            'credit_control_line_move_line_write_index': (
+                "SELECT id FROM account_move_line mv_line"
+                " WHERE mv_line.id IN %(ids)s"
+                " AND EXISTS (SELECT id FROM credit_control_line"
+                "             WHERE move_line_id = mv_line.id"
+                "             AND write_date > now())"),
+            'credit_control_line_draft_level_index': (
+                "SELECT id FROM credit_control_line"
+                " WHERE move_line_id IN %(ids)s"
+                " AND policy_level_id = %(id)s"
+                " AND state = 'draft'"),
+            'credit_control_line_queued_mail_index': (
+                "SELECT id FROM credit_control_line"
+                " WHERE mail_message_id IN %(ids)s"
+                " AND state = 'queued'"),
+        }
+        line_obj = self.env['credit.control.line']
+        for name, __ in line_obj._get_partial_indexes():
+            cr.execute(sql.SQL("EXPLAIN {}").format(sql.SQL(queries[name])),
+                       {'id': 1, 'ids': (1, 2, 3)})
+            plan = '\n'.join(row[0] for row in cr.fetchall())
+            self.assertIn(name, plan)
+
+    def test_set_state(self):
+        """
+        Lines change of state in bulk with a summary on the partner
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.with_context(lang='en_US').generate_credit_lines()
+        control_lines = self.invoice.credit_control_line_ids
+        partner = control_lines.mapped('partner_id')
+        messages = partner.message_ids
+
+        changed = control_lines._set_state('sent', from_states=('ignored',))
+        self.assertFalse(changed)
+        self.assertEqual(set(control_lines.mapped('state')), {'draft'})
+
+        move_lines = control_lines.mapped('move_line_id')
+        self.assertEqual(set(move_lines.mapped('credit_control_state')),
+                         {'draft'})
+        self.assertFalse(any(move_lines.mapped('credit_control_reminded')))
+        changed = control_lines._set_state('to_be_sent',
+                                           from_states=('draft',))
+        self.assertEqual(changed, control_lines)
+        self.assertEqual(set(control_lines.mapped('state')),
+                         {'to_be_sent'})
+        self.assertEqual(set(move_lines.mapped('credit_control_state')),
+                         {'to_be_sent'})
+        self.assertTrue(all(move_lines.mapped('credit_control_reminded')))
+        summary = partner.message_ids - messages
+        self.assertEqual(len(summary), 1)
+        self.assertIn('%d credit control lines' % len(control_lines),
+                      summary.body)
+
+        control_lines._set_state('ignored', summary=False)
+        self.assertFalse(any(move_lines.mapped('credit_control_state')))
+        self.assertFalse(any(move_lines.mapped('credit_control_reminded')))
+
+    def test_marker_background_job(self):
+        """
+        The marker run in background processes its lines with a job
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.with_context(lang='en_US').generate_credit_lines()
+        control_lines = self.invoice.credit_control_line_ids
+        marker = self.env['credit.control.marker'].create({
+            'name': 'to_be_sent',
+            'line_ids': [(6, 0, control_lines.ids)],
+            'run_in_background': True,
+        })
+        action = marker.mark_lines()
+        job = self.env['credit.control.job'].browse(action['res_id'])
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.line_ids, control_lines)
+        self.assertEqual(set(control_lines.mapped('state')), {'draft'})
+
+        job_model = self.env.registry['credit.control.job']
+        with mock.patch.object(job_model, '_commit_progress'):
+            job._process()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.done_count, len(control_lines))
+        self.assertEqual(job.progress, 100.0)
+        self.assertEqual(set(control_lines.mapped('state')), {'to_be_sent'})
+
+    def test_job_user(self):
+        """
+        The jobs are processed as the user who created them
+        """
+        user = self.env['res.users'].create({
+            'name': 'Credit controller',
+            'login': 'credit_controller',
+            'groups_id': [(6, 0, [
+                self.env.ref('base.group_user').id,
+                self.env.ref('account_credit_control.'
+                             'group_account_credit_control_user').id,
+            ])],
+        })
+        job = self.env['credit.control.job'].sudo(user).create({
+            'name': 'Job',
+            'action': 'mark',
+            'user_id': self.env.ref('base.user_admin').id,
+        })
+        self.assertEqual(job.user_id, user)
+        job.write({'user_id': self.env.ref('base.user_admin').id})
+        self.assertEqual(job.user_id, user)
+
+    def test_job_failed_chunk(self):
+        """
+        A failed job tells which chunk failed, the previous chunks stay
+        processed
+        """
+        control_run = self.env['credit.control.run'].create({
+            'date': fields.Date.today(),
+            'policy_ids': [(6, 0, [self.policy.id])],
+        })
+        control_run.with_context(lang='en_US').generate_credit_lines()
+        control_lines = self.invoice.credit_control_line_ids
+        self.env['ir.config_parameter'].sudo().set_param(
+            'account_credit_control.job_chunk_size', '1')
+        self.env['credit.control.job']._open_new_job(
+            'mark', control_lines, {'mark_state': 'to_be_sent'})
+        job = self.env['credit.control.job'].search([], limit=1)
+        self.assertEqual(len(job._get_chunks()), 1)
+
+        job_model = self.env.registry['credit.control.job']
+        with mock.patch.object(job_model, '_commit_progress'), \
+                mock.patch.object(job_model, '_process_chunk',
+                                  side_effect=UserError('Boom')), \
+                mock.patch.object(self.env.cr, 'rollback'):
+            job._process()
+        self.assertEqual(job.state, 'failed')
+        self.assertIn('Chunk 1 (%d lines of %s)' % (
+            len(control_lines), self.invoice.partner_id.display_name),
+            job.error)
+        self.assertIn('Boom', job.error)
+        self.assertFalse(job.done_line_ids)
+
     def test_multi_credit_control_run(self):
         """
         Generate several control run
@@ -184,7 +1332,17 @@ class TestCreditControlRun(TransactionCase):
         wiz_emailer.line_ids = control_lines
 
         # Send email
+        comm_obj = self.env['credit.control.communication']
+        comm_count = comm_obj.search_count([])
         wiz_emailer.email_lines()
+        # the communications are deleted once the emails are generated
+        self.assertEqual(comm_obj.search_count([]), comm_count)
+        for line in control_lines:
+            self.assertTrue(line.mail_message_id)
+            self.assertIn(line.state, ('queued', 'email_error'))
+            self.assertTrue(line.mail_message_id.attachment_ids)
+            self.assertEqual(line.move_line_id.credit_control_state,
+                             line.state)
 
     def test_wiz_credit_control_emailer(self):
         """
@@ -33,3 +33,54 @@ class TestCreditControlPolicyLevel(TransactionCase):
         })
         partner.property_account_receivable_id = account.id
         partner.credit_policy_id = policy.id
+
+    def test_get_invoice_addresses(self):
+        """
+        The invoice addresses resolved in batch are the ones of address_get
+        """
+        partner_obj = self.env['res.partner']
+        company = partner_obj.create({
+            'name': 'Company',
+            'is_company': True,
+        })
+        contact = partner_obj.create({
+            'name': 'Contact',
+            'parent_id': company.id,
+            'type': 'contact',
+        })
+        nested_invoice = partner_obj.create({
+            'name': 'Nested Invoice',
+            'parent_id': contact.id,
+            'type': 'invoice',
+        })
+        invoice = partner_obj.create({
+            'name': 'Invoice',
+            'parent_id': company.id,
+            'type': 'invoice',
+        })
+        partner_obj.create({
+            'name': 'Archived Invoice',
+            'parent_id': company.id,
+            'type': 'invoice',
+            'active': False,
+        })
+        subsidiary = partner_obj.create({
+            'name': 'Subsidiary',
+            'parent_id': company.id,
+            'is_company': True,
+        })
+        delivery = partner_obj.create({
+            'name': 'Delivery',
+            'parent_id': subsidiary.id,
+            'type': 'delivery',
+        })
+        single = partner_obj.create({
+            'name': 'Single',
+        })
+        partners = (company | contact | nested_invoice | invoice |
+                    subsidiary | delivery | single)
+        addresses = partners._get_invoice_addresses()
+        for partner in partners:
+            self.assertEqual(addresses[partner.id],
+                             partner.address_get(['invoice'])['invoice'],
+                             partner.name)
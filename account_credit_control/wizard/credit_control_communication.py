@@ -2,7 +2,10 @@
 # Copyright 2017 Okia SPRL (https://okia.be)
 # Copyright 2018 Access Bookings Ltd (https://accessbookings.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from psycopg2 import sql
+
 from odoo import api, fields, models
+from ..models.sql_ids import ids_condition
 
 
 class CreditControlCommunication(models.TransientModel):
@@ -39,6 +42,11 @@ class CreditControlCommunication(models.TransientModel):
         comodel_name='res.partner',
         readonly=True,
     )
+    contact_email = fields.Char(
+        readonly=True,
+        help="Email of the contact address, or of its commercial entity "
+             "when the contact has none.",
+    )
     report_date = fields.Date(
         default=lambda self: fields.Date.context_today(self),
     )
@@ -88,19 +96,48 @@ class CreditControlCommunication(models.TransientModel):
     @api.model_create_multi
     @api.returns('self', lambda value: value.id)
     def create(self, vals_list):
+        self._set_contacts(vals_list)
+        return super(CreditControlCommunication, self).create(vals_list)
+
+    @api.model
+    def _set_contacts(self, vals_list):
+        """ Fill the contact address and email of the communications for
+        all their partners at once
+        """
+        # the computed field does not work in TransientModel,
+        # just set a value on creation
+        partner_ids = [vals['partner_id'] for vals in vals_list
+                       if vals.get('partner_id')]
+        contacts = self._get_contacts(partner_ids)
         for vals in vals_list:
             if vals.get('partner_id'):
-                # the computed field does not work in TransientModel,
-                # just set a value on creation
-                partner_id = vals['partner_id']
-                vals['contact_address'] = \
-                    self._get_contact_address(partner_id).id
-        return super(CreditControlCommunication, self).create(vals_list)
+                contact_id, email = contacts[vals['partner_id']]
+                vals['contact_address'] = contact_id
+                vals['contact_email'] = email
+
+    @api.model
+    def _get_contacts(self, partner_ids):
+        """ Return the invoice address of partners and its email
+
+        :return: dict with a tuple of the contact address id and the
+            email for every partner id
+        """
+        partners = self.env['res.partner'].browse(set(partner_ids))
+        addresses = partners._get_invoice_addresses()
+        # the emails of the contacts are read in batch by the prefetching
+        emails = {
+            contact.id: contact.email or contact.commercial_partner_id.email
+            for contact in partners.browse(set(addresses.values()))
+        }
+        return {partner_id: (contact_id, emails[contact_id])
+                for partner_id, contact_id in addresses.items()}
 
     @api.multi
     def get_email(self):
         """ Return a valid email for customer """
         self.ensure_one()
+        if self.contact_email:
+            return self.contact_email
         contact = self.contact_address
         email = contact.email
         if not email and contact.commercial_partner_id.email:
@@ -140,35 +177,38 @@ class CreditControlCommunication(models.TransientModel):
     def _generate_comm_from_credit_lines(self, lines):
         """ Aggregate credit control line by partner, level, and currency
         It also generate a communication object per aggregation.
+
+        The lines of every aggregation are collected by the grouping query
+        itself, the communications are created in one batch.
         """
         comms = self.browse()
         if not lines:
             return comms
-        sql = (
-            "SELECT distinct partner_id, policy_level_id, "
+        query = sql.SQL(
+            "SELECT partner_id, policy_level_id, "
             " credit_control_line.currency_id, "
-            " credit_control_policy_level.level"
+            " array_agg(credit_control_line.id "
+            "           ORDER BY credit_control_line.id) AS line_ids"
             " FROM credit_control_line JOIN credit_control_policy_level "
             "   ON (credit_control_line.policy_level_id = "
             "       credit_control_policy_level.id)"
-            " WHERE credit_control_line.id in %s"
+            " WHERE {}"
+            " GROUP BY partner_id, policy_level_id, "
+            "          credit_control_line.currency_id, "
+            "          credit_control_policy_level.level"
             " ORDER by credit_control_policy_level.level, "
             "          credit_control_line.currency_id"
         )
         cr = self.env.cr
-        cr.execute(sql, (tuple(lines.ids), ))
-        res = cr.dictfetchall()
+        with ids_condition(cr, 'credit_control_line.id', lines.ids,
+                           'line_ids') as (condition, params):
+            cr.execute(query.format(condition), params)
+            res = cr.dictfetchall()
         company_currency = self.env.user.company_id.currency_id
         datas = []
         for group in res:
             data = {}
-            level_lines = self._get_credit_lines(
-                lines.ids,
-                group['partner_id'],
-                group['policy_level_id'],
-                group['currency_id'],
-            )
-            data['credit_control_line_ids'] = [(6, 0, level_lines.ids)]
+            data['credit_control_line_ids'] = [(6, 0, group['line_ids'])]
             data['partner_id'] = group['partner_id']
             data['current_policy_level'] = group['policy_level_id']
             data['currency_id'] = group['currency_id'] or company_currency.id
@@ -176,58 +216,128 @@ class CreditControlCommunication(models.TransientModel):
         comms = self.create(datas)
         return comms
 
+    @api.model
+    @api.returns('mail.mail')
+    def _generate_emails_from_credit_lines(self, lines):
+        """ Generate the emails of credit lines through communications which
+        are deleted once the emails are generated
+
+        The communications are only the rendering context of the email
+        templates, deleting them at once leaves only the emails and the
+        state of the credit lines to the transaction, instead of transient
+        records waiting for the vacuum.
+        """
+        comms = self._generate_comm_from_credit_lines(lines)
+        emails = comms._generate_emails()
+        comms.unlink()
+        return emails
+
     @api.multi
     @api.returns('mail.mail')
     def _generate_emails(self):
-        """ Generate email message using template related to level """
-        emails = self.env['mail.mail']
+        """ Generate email message using template related to level
+
+        The communications are rendered with one ``generate_email`` call per
+        template, which renders them per language, then the emails, their
+        attachments and the state of the credit lines are written in batch.
+        """
         required_fields = [
             'subject',
             'body_html',
             'email_from',
             'email_to',
         ]
+        comm_ids_by_template = {}
         for comm in self:
             template = comm.current_policy_level.email_template_id
-            email_values = template.generate_email(comm.id)
+            comm_ids_by_template.setdefault(template, []).append(comm.id)
+        values_by_comm = {}
+        for template, comm_ids in comm_ids_by_template.items():
+            values_by_comm.update(template.generate_email(comm_ids))
+
+        vals_list = []
+        attachment_lists = []
+        states = []
+        for comm in self:
+            email_values = values_by_comm[comm.id]
             email_values['message_type'] = 'email'
             # model is Transient record (self) removed periodically so no point
             # of storing res_id
             email_values.pop('model', None)
             email_values.pop('res_id', None)
             # Remove when mail.template returns correct format attachments
-            attachment_list = email_values.pop('attachments', None)
-            email = emails.create(email_values)
-
-            state = 'sent'
+            attachment_lists.append(email_values.pop('attachments', None))
+            vals_list.append(email_values)
             # The mail will not be send, however it will be in the pool, in an
             # error state. So we create it, link it with
             # the credit control line
             # and put this latter in a `email_error` state we not that we have
             # a problem with the email
-            if not all(email_values.get(field) for field in required_fields):
-                state = 'email_error'
-            comm.credit_control_line_ids.write({
-                'mail_message_id': email.id,
-                'state': state,
-            })
-            email.attachment_ids = [(0, 0, {
+            if all(email_values.get(field) for field in required_fields):
+                # the lines are sent once the dispatch queue delivered it
+                email_values['credit_control_queued'] = True
+                states.append('queued')
+            else:
+                states.append('email_error')
+        emails = self.env['mail.mail'].create(vals_list)
+
+        # every email gets its own attachments, which are checked against
+        # its access rights, the filestore keeps identical contents once
+        attachment_vals = []
+        for email, attachment_list in zip(emails, attachment_lists):
+            attachment_vals += [{
                 'name': att[0],
                 'datas': att[1],
                 'datas_fname': att[0],
                 'res_model': 'mail.mail',
                 'res_id': email.id,
                 'type': 'binary',
-            }) for att in attachment_list]
-            emails |= email
+            } for att in attachment_list or []]
+        attachments = self.env['ir.attachment'].create(attachment_vals)
+        emails._link_attachments(attachments)
+
+        self._write_credit_lines_email(emails, states)
         return emails
 
+    @api.multi
+    def _write_credit_lines_email(self, emails, states):
+        """ Link the credit lines of the communications to their email and
+        set their state with a single query
+
+        :param emails: recordset of mail.mail, one per communication
+        :param states: list of states of the credit lines, one per
+            communication
+        """
+        line_ids = []
+        mail_ids = []
+        line_states = []
+        for comm, email, state in zip(self, emails, states):
+            for line_id in comm.credit_control_line_ids.ids:
+                line_ids.append(line_id)
+                mail_ids.append(email.id)
+                line_states.append(state)
+        if not line_ids:
+            return
+        self.env.cr.execute(
+            "UPDATE credit_control_line cr_line\n"
+            " SET mail_message_id = email.mail_id,\n"
+            "     state = email.state,\n"
+            "     write_uid = %s,\n"
+            "     write_date = now() at time zone 'UTC'\n"
+            " FROM unnest(%s::integer[], %s::integer[], %s::varchar[])\n"
+            "   AS email(line_id, mail_id, state)\n"
+            " WHERE cr_line.id = email.line_id",
+            (self.env.uid, line_ids, mail_ids, line_states))
+        lines = self.mapped('credit_control_line_ids')
+        lines.invalidate_cache(['mail_message_id', 'state', 'write_uid',
+                                'write_date'], lines.ids)
+        # recompute the current credit control state of the move lines
+        lines.modified(['mail_message_id', 'state'])
+        lines.recompute()
+
     @api.multi
     @api.returns('credit.control.line')
     def _mark_credit_line_as_sent(self):
-        lines = self.env['credit.control.line']
-        for comm in self:
-            lines |= comm.credit_control_line_ids
-
-        lines.write({'state': 'sent'})
+        lines = self.mapped('credit_control_line_ids')
+        lines._set_state('sent')
         return lines
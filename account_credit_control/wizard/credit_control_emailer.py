@@ -32,6 +32,10 @@ class CreditControlEmailer(models.TransientModel):
             ('channel', '=', 'email'),
         ],
     )
+    run_in_background = fields.Boolean(
+        help="Send the emails with a background job which reports its "
+             "progress, for large selections of lines.",
+    )
 
     @api.model
     @api.returns('credit.control.line')
@@ -54,6 +58,8 @@ class CreditControlEmailer(models.TransientModel):
         comm_obj = self.env['credit.control.communication']
 
         filtered_lines = self._filter_lines(self.line_ids)
-        comms = comm_obj._generate_comm_from_credit_lines(filtered_lines)
-        comms._generate_emails()
+        if self.run_in_background:
+            return self.env['credit.control.job']._open_new_job(
+                'email', filtered_lines)
+        comm_obj._generate_emails_from_credit_lines(filtered_lines)
         return {'type': 'ir.actions.act_window_close'}
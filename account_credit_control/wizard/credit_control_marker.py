@@ -37,6 +37,10 @@ class CreditControlMarker(models.TransientModel):
         default=lambda self: self._default_lines(),
         domain="[('state', '!=', 'sent')]",
     )
+    run_in_background = fields.Boolean(
+        help="Change the state of the lines with a background job which "
+             "reports its progress, for large selections of lines.",
+    )
 
     @api.model
     @api.returns('credit.control.line')
@@ -49,9 +53,18 @@ class CreditControlMarker(models.TransientModel):
     @api.model
     @api.returns('credit.control.line')
     def _mark_lines(self, filtered_lines, state):
-        """ write hook """
+        """ write hook
+
+        The lines are changed with ``_set_state``, which does not call
+        ``write``. Its ``from_states`` are all the states but ``sent``, so
+        they only skip the lines sent since ``_filter_lines`` selected
+        them, the lines of every other state are changed.
+        """
         assert state
-        filtered_lines.write({'state': state})
+        line_obj = self.env['credit.control.line']
+        from_states = [key for key, __ in line_obj._fields['state'].selection
+                       if key != 'sent']
+        filtered_lines._set_state(state, from_states=from_states)
         return filtered_lines
 
     @api.multi
@@ -68,6 +81,10 @@ class CreditControlMarker(models.TransientModel):
             raise UserError(_('No lines will be changed. '
                               'All the selected lines are already done.'))
 
+        if self.run_in_background:
+            return self.env['credit.control.job']._open_new_job(
+                'mark', filtered_lines, {'mark_state': self.name})
+
         self._mark_lines(filtered_lines, self.name)
 
         return {
@@ -2,8 +2,21 @@
 # Copyright 2017 Okia SPRL (https://okia.be)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import io
+import logging
+import os
+import tempfile
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from PyPDF2 import PdfFileMerger, PdfFileReader, PdfFileWriter
+
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
 
 
 class CreditControlPrinter(models.TransientModel):
@@ -30,6 +43,34 @@ class CreditControlPrinter(models.TransientModel):
         string='Credit Control Lines',
         default=lambda self: self._default_line_ids(),
     )
+    run_in_background = fields.Boolean(
+        help="Print the letters with a background job which reports its "
+             "progress and attaches the documents to the job, for large "
+             "selections of lines.",
+    )
+    output = fields.Selection(
+        selection=[
+            ('report', 'Report'),
+            ('pdf', 'Merged PDF File'),
+            ('zip', 'ZIP of Partner Letters'),
+        ],
+        required=True,
+        default='report',
+        help="The files are rendered per chunk of letters on the disk of "
+             "the server, which suits large batches of letters.",
+    )
+    export_path = fields.Char(
+        readonly=True,
+        copy=False,
+    )
+    export_filename = fields.Char(
+        readonly=True,
+        copy=False,
+    )
+    export_token = fields.Char(
+        readonly=True,
+        copy=False,
+    )
 
     @api.model
     def _credit_line_predicate(self, line):
@@ -48,6 +89,9 @@ class CreditControlPrinter(models.TransientModel):
             raise UserError(_('No credit control lines selected.'))
 
         lines = self._get_lines(self.line_ids, self._credit_line_predicate)
+        if self.run_in_background:
+            return self.env['credit.control.job']._open_new_job(
+                'print', lines, {'mark_as_sent': self.mark_as_sent})
 
         comms = comm_obj._generate_comm_from_credit_lines(lines)
 
@@ -57,4 +101,278 @@ class CreditControlPrinter(models.TransientModel):
         report_name = 'account_credit_control.report_credit_control_summary'
         report_obj = self.env['ir.actions.report']._get_report_from_name(
             report_name)
-        return report_obj.report_action(comms)
+        if self.output == 'report':
+            return report_obj.report_action(comms)
+        self._export_letters(report_obj, comms)
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/account_credit_control/letters/%s/%s' % (
+                self.id, self.export_token),
+            'target': 'self',
+        }
+
+    @api.model
+    def _get_report_workers(self):
+        """ Number of wkhtmltopdf processes rendering the letters """
+        company = self.env.user.company_id
+        return max(company.credit_control_report_workers, 1)
+
+    @api.model
+    def _get_report_chunks(self, comms, workers):
+        """ Split communications in chunks rendered by the workers
+
+        A few chunks are given to every worker so a slow chunk does not
+        hold the others, a chunk having at most the size of the export
+        chunks.
+
+        :return: list of recordsets of communications, in their order
+        """
+        nb_chunks = min(len(comms), workers * 4)
+        if not nb_chunks:
+            return []
+        size = min(-(-len(comms) // nb_chunks),
+                   self._get_export_chunk_size())
+        return [comms[index:index + size]
+                for index in range(0, len(comms), size)]
+
+    @api.model
+    def _render_pdf_chunks(self, report, comms, directory):
+        """ Render the letters of the communications in a PDF file per
+        chunk of letters
+
+        The HTML of the chunks is rendered on the current cursor, the
+        conversion to PDF, which does not need the communications, is done
+        by parallel wkhtmltopdf processes. The chunks are rendered in waves
+        of one chunk per worker, so only the HTML of a wave is kept in
+        memory, and the cache is emptied between the waves.
+
+        :param directory: directory of the PDF files of the chunks
+        :return: list of tuples with the communications of a chunk and the
+            path of its PDF file, in the order of the communications
+        """
+        workers = self._get_report_workers()
+        report = report.with_context(debug=False)
+        chunks = self._get_report_chunks(comms, workers)
+        paths = []
+        for index in range(0, len(chunks), workers):
+            wave = []
+            for chunk in chunks[index:index + workers]:
+                html = report.render_qweb_html(chunk.ids)[0]
+                bodies, __, header, footer, specific_paperformat_args = \
+                    report._prepare_html(html)
+                fd, path = tempfile.mkstemp(suffix='.pdf', dir=directory)
+                os.close(fd)
+                wave.append((path, bodies, header, footer,
+                             specific_paperformat_args))
+            if workers == 1:
+                self._write_pdf_chunk(report, *wave[0])
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(self._render_pdf_chunk, report.id,
+                                        *chunk_args)
+                        for chunk_args in wave
+                    ]
+                for future in futures:
+                    future.result()
+            paths += [chunk_args[0] for chunk_args in wave]
+            self.invalidate_cache()
+        return list(zip(chunks, paths))
+
+    @api.model
+    def _write_pdf_chunk(self, report, path, bodies, header, footer,
+                         specific_paperformat_args):
+        """ Convert the HTML bodies of a chunk of letters to a PDF file """
+        context = report.env.context
+        pdf = report._run_wkhtmltopdf(
+            bodies,
+            header=header,
+            footer=footer,
+            landscape=context.get('landscape'),
+            specific_paperformat_args=specific_paperformat_args,
+            set_viewport_size=context.get('set_viewport_size'),
+        )
+        with open(path, 'wb') as pdf_file:
+            pdf_file.write(pdf)
+
+    @api.model
+    def _render_pdf_chunk(self, report_id, *chunk_args):
+        """ Convert the HTML bodies of a chunk of letters to a PDF file
+
+        Called in a worker thread, so it works on a new cursor.
+        """
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            report = env['ir.actions.report'].browse(report_id)
+            self.with_env(env)._write_pdf_chunk(report, *chunk_args)
+
+    @api.model
+    def _get_export_chunk_size(self):
+        """ Number of letters rendered at once in an exported file """
+        return 50
+
+    @api.model
+    def _get_export_directory(self):
+        directory = os.path.join(config['data_dir'], 'credit_control_letters',
+                                 self.env.cr.dbname)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    @api.multi
+    def _export_letters(self, report, comms):
+        """ Write the letters of the communications in a file on the disk
+
+        The letters are rendered per chunk and the cache is emptied between
+        the chunks, so the memory does not grow with the number of letters.
+        """
+        self.ensure_one()
+        fd, path = tempfile.mkstemp(suffix='.%s' % self.output,
+                                    dir=self._get_export_directory())
+        os.close(fd)
+        if self.output == 'zip':
+            self._export_letters_zip(report, comms, path)
+        else:
+            self._export_letters_pdf(report, comms, path)
+        self.write({
+            'export_path': path,
+            'export_filename': '%s.%s' % (report.name, self.output),
+            'export_token': uuid.uuid4().hex,
+        })
+
+    @api.model
+    def _get_letters_pages(self, reader, nb_letters):
+        """ Find the pages of the letters of a PDF file with its outline
+
+        wkhtmltopdf adds the headings of the letters to the outline of the
+        file, every letter starting with a top-level heading, as for the
+        split of the reports saved per record in attachment.
+
+        :param reader: PdfFileReader of the file
+        :param nb_letters: number of letters in the file
+        :return: list of the ranges of the pages of the letters, or None
+            when the outline does not match the letters
+        """
+        starts = sorted({
+            reader.getDestinationPageNumber(outline)
+            for outline in reader.getOutlines()
+            # the nested lists are the outlines of the lower headings
+            if not isinstance(outline, list)
+        })
+        if len(starts) != nb_letters or starts[:1] != [0]:
+            return None
+        ends = starts[1:] + [reader.getNumPages()]
+        return [range(start, end) for start, end in zip(starts, ends)]
+
+    @api.model
+    def _split_letters(self, report, comms, path, directory, open_files):
+        """ Split the PDF file of a chunk of letters per letter
+
+        A chunk whose outline does not match its letters is rendered again
+        letter per letter.
+
+        :param open_files: list receiving the files opened for the readers
+        :return: list of tuples with the communication of a letter, the
+            PdfFileReader of its file and the range of its pages
+        """
+        pdf_file = open(path, 'rb')
+        open_files.append(pdf_file)
+        reader = PdfFileReader(pdf_file, strict=False)
+        pages = self._get_letters_pages(reader, len(comms))
+        if pages is not None:
+            return [(comm, reader, comm_pages)
+                    for comm, comm_pages in zip(comms, pages)]
+        _logger.warning("The outline of the PDF of %d letters does not "
+                        "match the letters, rendering them one by one",
+                        len(comms))
+        letters = []
+        for comm in comms:
+            for __, letter_path in self._render_pdf_chunks(report, comm,
+                                                           directory):
+                letter_file = open(letter_path, 'rb')
+                open_files.append(letter_file)
+                letter_reader = PdfFileReader(letter_file, strict=False)
+                letters.append((comm, letter_reader,
+                                range(letter_reader.getNumPages())))
+        return letters
+
+    @api.model
+    def _write_partner_letters(self, archive, partner, writer):
+        """ Add the PDF of the letters of a partner to the ZIP archive """
+        filename = '%s - %s.pdf' % (
+            partner.id, partner.display_name.replace('/', '_'))
+        stream = io.BytesIO()
+        writer.write(stream)
+        archive.writestr(filename, stream.getvalue())
+
+    @api.model
+    def _export_letters_zip(self, report, comms, path):
+        """ Write a ZIP archive with a PDF of the letters of every partner
+
+        The letters, sorted per partner, are rendered per chunk and the
+        PDF files of the chunks are split per letter, so a partner having
+        letters in several chunks gets a single file.
+        """
+        comms = comms.sorted(key=lambda comm: comm.partner_id.id)
+        directory = self._get_export_directory()
+        open_files = []
+        try:
+            with tempfile.TemporaryDirectory(dir=directory) as chunks_dir, \
+                    zipfile.ZipFile(path, 'w',
+                                    zipfile.ZIP_DEFLATED) as archive:
+                partner = writer = None
+                for chunk, chunk_path in self._render_pdf_chunks(
+                        report, comms, chunks_dir):
+                    letters = self._split_letters(report, chunk, chunk_path,
+                                                  chunks_dir, open_files)
+                    for index, (comm, reader, pages) in enumerate(letters):
+                        if comm.partner_id != partner:
+                            if writer is not None:
+                                self._write_partner_letters(
+                                    archive, partner, writer)
+                                # close the files the next letters do not
+                                # read
+                                streams = {letter[1].stream
+                                           for letter in letters[index:]}
+                                for pdf_file in open_files:
+                                    if pdf_file not in streams:
+                                        pdf_file.close()
+                                open_files[:] = [
+                                    pdf_file for pdf_file in open_files
+                                    if pdf_file in streams]
+                            partner = comm.partner_id
+                            writer = PdfFileWriter()
+                        for page in pages:
+                            writer.addPage(reader.getPage(page))
+                if writer is not None:
+                    self._write_partner_letters(archive, partner, writer)
+        finally:
+            for pdf_file in open_files:
+                pdf_file.close()
+
+    @api.model
+    def _export_letters_pdf(self, report, comms, path):
+        """ Write a PDF of all the letters, the PDF files of the chunks of
+        letters being concatenated from the disk
+        """
+        directory = self._get_export_directory()
+        with tempfile.TemporaryDirectory(dir=directory) as chunks_dir:
+            merger = PdfFileMerger(strict=False)
+            try:
+                for __, chunk_path in self._render_pdf_chunks(
+                        report, comms, chunks_dir):
+                    merger.append(chunk_path, import_bookmarks=False)
+                merger.write(path)
+            finally:
+                merger.close()
+
+    @api.multi
+    def unlink(self):
+        paths = [path for path in self.mapped('export_path') if path]
+        res = super(CreditControlPrinter, self).unlink()
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                _logger.warning("Could not remove the letters file %s",
+                                path)
+        return res